@@ -0,0 +1,430 @@
+# coding=utf-8
+# Measures the per-line cost of the gcode hooks and the runout detection latency using the simulated GPIO
+# backend, results are printed as JSON so they can be compared between releases.
+#
+#   python benchmarks/benchmark.py --lines 200000 --trials 20 --output bench.json
+from __future__ import absolute_import, print_function
+
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from octoprint.events import Events  # noqa: E402
+
+import octoprint_filamentsensorsimplified as plugin_module  # noqa: E402
+from octoprint_filamentsensorsimplified.gpio_backend import SimulatedGPIOBackend, bounce_script  # noqa: E402
+
+PIN = 7
+# pin 7 is pulled up (sensor connected to ground, triggered when open), so low means filament present
+LEVEL_PRESENT = 0
+LEVEL_RUNOUT = 1
+# encoder of the jam detection
+ENCODER_PIN = 13
+
+
+class BenchSettings(object):
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, path, **kwargs):
+        return self.values.get(path[0])
+
+    def get_int(self, path, **kwargs):
+        value = self.values.get(path[0])
+        return None if value is None else int(value)
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.values.get(path[0]))
+
+    def set(self, path, value, **kwargs):
+        self.values[path[0]] = value
+
+
+class BenchPrinter(object):
+    def __init__(self):
+        self.commands_sent = []
+        self.command_event = threading.Event()
+
+    def commands(self, commands, **kwargs):
+        self.commands_sent.append((timer(), commands))
+        self.command_event.set()
+
+    def pause_print(self, *args, **kwargs):
+        self.commands("pause")
+
+    def cancel_print(self, *args, **kwargs):
+        pass
+
+
+class StreamingPrinter(BenchPrinter):
+    # stands in for OctoPrint's send queue and comm: a line goes through the sending hook every line_interval
+    # seconds, commands() appends behind the queue_depth lines already waiting. Like OctoPrint it ignores list
+    # results of the sending hook, lines put back with prepend() skip the hook.
+    def __init__(self, stream, queue_depth, line_interval):
+        BenchPrinter.__init__(self)
+        self.stream = stream
+        self.queue_depth = queue_depth
+        self.line_interval = line_interval
+        self.queue = collections.deque()
+        self.sent = 0
+        # number of lines sent when the runout action went out
+        self.action_sent = None
+        self.action = None
+        self.hook = None
+        self.running = False
+        self._position = 0
+        # the plugin reaches the send queue through the comm instance
+        self._send_queue = self
+        self.rejected = 0
+
+    def commands(self, commands, **kwargs):
+        self.queue.append((commands, commands.split(" ", 1)[0], False))
+
+    def prepend(self, entry):
+        command, linenumber, command_type, on_sent, processed, tags = entry
+        self.queue.appendleft((command, command.split(" ", 1)[0], processed))
+
+    def start(self, hook, action):
+        self.hook = hook
+        self.action = action
+        self.running = True
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self):
+        while self.running:
+            while len(self.queue) < self.queue_depth:
+                cmd, gcode = self.stream[self._position % len(self.stream)]
+                self.queue.append((cmd, gcode, False))
+                self._position += 1
+            cmd, gcode, processed = self.queue.popleft()
+            line = cmd
+            if not processed:
+                result = self.hook(self, "sending", cmd, None, gcode)
+                if isinstance(result, list) and len(result) == 1:
+                    result = result[0]
+                if isinstance(result, list):
+                    # OctoPrint only takes multi-entry results in the queuing phase and sends the line as-is
+                    self.rejected += 1
+                elif isinstance(result, str):
+                    line = result
+            if line == self.action and self.action_sent is None:
+                self.action_sent = self.sent
+                self.command_event.set()
+            self.sent += 1
+            time.sleep(self.line_interval)
+
+
+class BenchPluginManager(object):
+    def __init__(self):
+        self.messages = 0
+
+    def send_plugin_message(self, identifier, data):
+        self.messages += 1
+
+
+def create_plugin(settings):
+    plugin = plugin_module.Filament_sensor_simplifiedPlugin()
+    values = plugin.get_settings_defaults()
+    values.update(settings)
+    plugin._identifier = "filamentsensorsimplified"
+    plugin._plugin_version = plugin_module.__plugin_version__
+    plugin._logger = logging.getLogger("octoprint.plugins.filamentsensorsimplified")
+    plugin._settings = BenchSettings(values)
+    plugin._printer = BenchPrinter()
+    plugin._plugin_manager = BenchPluginManager()
+    # the runout history is written to a throwaway folder
+    plugin._data_folder = tempfile.mkdtemp(prefix="filamentsensorsimplified-bench-")
+    plugin.initialize()
+    return plugin
+
+
+# slicer-like gcode stream: mostly extrusion moves with some travel, fan, temperature and retraction lines
+def gcode_stream(lines, seed=0):
+    rng = random.Random(seed)
+    stream = []
+    e = 0.0
+    for i in range(lines):
+        roll = rng.random()
+        if roll < 0.80:
+            e += rng.uniform(0.01, 0.5)
+            stream.append("G1 X%.3f Y%.3f E%.5f" % (rng.uniform(0, 220), rng.uniform(0, 220), e))
+        elif roll < 0.93:
+            stream.append("G0 F9000 X%.3f Y%.3f" % (rng.uniform(0, 220), rng.uniform(0, 220)))
+        elif roll < 0.96:
+            stream.append("G92 E0")
+            e = 0.0
+        elif roll < 0.98:
+            stream.append("M105")
+        else:
+            stream.append("M106 S%d" % rng.randint(0, 255))
+    return [(line, line.split(" ", 1)[0]) for line in stream]
+
+
+# firmware responses, mostly plain acknowledgements with temperature reports and busy messages mixed in
+def response_stream(lines, seed=0):
+    rng = random.Random(seed)
+    stream = []
+    for i in range(lines):
+        roll = rng.random()
+        if roll < 0.90:
+            stream.append("ok")
+        elif roll < 0.97:
+            stream.append("ok T:%.1f /210.0 B:%.1f /60.0 @:64 B@:0" % (rng.uniform(205, 215), rng.uniform(58, 62)))
+        elif roll < 0.995:
+            stream.append("echo:busy: processing")
+        else:
+            stream.append("busy: paused for user")
+    return stream
+
+
+def noop_sending(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+    return None
+
+
+def noop_received(comm, line, *args, **kwargs):
+    return line
+
+
+def time_sending(hook, stream, repeats):
+    best = None
+    for _ in range(repeats):
+        start = timer()
+        for cmd, gcode in stream:
+            hook(None, "sending", cmd, None, gcode)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e9 / len(stream)
+
+
+def time_received(hook, stream, repeats):
+    best = None
+    for _ in range(repeats):
+        start = timer()
+        for line in stream:
+            hook(None, line)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e9 / len(stream)
+
+
+def reset_workflow(plugin):
+    plugin.on_event(Events.PRINT_DONE, {})
+
+
+def benchmark_hooks(lines, repeats):
+    plugin = create_plugin(dict(pin=0, gpio_backend="simulated"))
+    gcode = gcode_stream(lines)
+    responses = response_stream(lines)
+    baseline_sending = time_sending(noop_sending, gcode, repeats)
+    baseline_received = time_received(noop_received, responses, repeats)
+
+    results = dict(lines=lines, repeats=repeats,
+                   noop_sending_ns_per_line=baseline_sending,
+                   noop_received_ns_per_line=baseline_received)
+
+    reset_workflow(plugin)
+    results["sending_idle_ns_per_line"] = time_sending(plugin.sending_gcode, gcode, repeats)
+    results["received_idle_ns_per_line"] = time_received(plugin.gcode_response_received, responses, repeats)
+
+    # filament change in progress, the hooks do their full checks on every line
+    def start_change():
+        reset_workflow(plugin)
+        plugin.sending_gcode(None, "sending", "M600", None, "M600")
+
+    start_change()
+    results["received_change_ns_per_line"] = time_received(plugin.gcode_response_received, responses, repeats)
+    start_change()
+    results["sending_change_ns_per_line"] = time_sending(plugin.sending_gcode, gcode, repeats)
+
+    # jam detection on, every line goes through the extrusion tracker
+    tracking = create_plugin(dict(pin=0, jam_pin=ENCODER_PIN, gpio_backend="simulated"))
+    tracking.start_gpio()
+    reset_workflow(tracking)
+    results["sending_tracking_ns_per_line"] = time_sending(tracking.sending_gcode, gcode, repeats)
+
+    for name in ("sending_idle", "sending_change", "sending_tracking"):
+        results[name + "_overhead_ns"] = results[name + "_ns_per_line"] - baseline_sending
+    for name in ("received_idle", "received_change"):
+        results[name + "_overhead_ns"] = results[name + "_ns_per_line"] - baseline_received
+    return results
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# puts the filament back, edge detection only reacts to runouts so the sampler is told to look again
+def insert_filament(plugin):
+    plugin.gpio.set_level(PIN, LEVEL_PRESENT)
+    plugin.sampler.poke()
+    return wait_for_present(plugin, True)
+
+
+def wait_for_present(plugin, present, timeout=2.0):
+    sensor = plugin.sensors[0]
+    deadline = time.time() + timeout
+    while sensor.present is not present and time.time() < deadline:
+        time.sleep(0.001)
+    return sensor.present is present
+
+
+# edge_detection=False makes adding edge detection fail so the sensor is polled
+def create_backend_without_edges():
+    gpio = SimulatedGPIOBackend()
+
+    def add_event_detect(pin, edge, callback, bouncetime):
+        raise RuntimeError("Failed to add edge detection")
+
+    gpio.add_event_detect = add_event_detect
+    return gpio
+
+
+def benchmark_detection(trials, bounces, glitch_ms, settings, edge_detection=True):
+    plugin = create_plugin(dict(settings, pin=PIN, gpio_backend="simulated"))
+    if not edge_detection:
+        plugin.create_gpio_backend = create_backend_without_edges
+    plugin.on_after_startup()
+    plugin.wait_until_ready(5)
+    gpio = plugin.gpio
+    printer = plugin._printer
+
+    # edge detection drops edges closer than the bounce time, keep the trials apart
+    pause = plugin.bounce_time / 1000.0 + 0.05
+
+    latencies = []
+    missed = 0
+    for trial in range(trials):
+        insert_filament(plugin)
+        plugin.on_event(Events.PRINT_STARTED, {})
+        time.sleep(pause)
+        printer.command_event.clear()
+        del printer.commands_sent[:]
+
+        edge = timer()
+        gpio.play(PIN, bounce_script(LEVEL_RUNOUT, bounces=bounces, seed=trial)).join()
+        if printer.command_event.wait(5):
+            latencies.append((printer.commands_sent[0][0] - edge) * 1000)
+        else:
+            missed += 1
+        plugin.on_event(Events.PRINT_DONE, {})
+        insert_filament(plugin)
+        time.sleep(pause)
+
+    # short glitches on a sensor that has filament must not trigger a runout
+    false_triggers = 0
+    plugin.on_event(Events.PRINT_STARTED, {})
+    for trial in range(trials):
+        del printer.commands_sent[:]
+        glitch = glitch_ms / 1000.0
+        script = bounce_script(LEVEL_RUNOUT, bounces=bounces, duration=glitch / 2, seed=trial)
+        script.append((glitch, LEVEL_PRESENT))
+        gpio.play(PIN, script).join()
+        time.sleep(pause + plugin.setting_debounce_deadline / 1000.0)
+        if printer.commands_sent:
+            false_triggers += 1
+            plugin.on_event(Events.PRINT_DONE, {})
+            insert_filament(plugin)
+            plugin.on_event(Events.PRINT_STARTED, {})
+    plugin.on_event(Events.PRINT_DONE, {})
+    polled = plugin.sensors[0].polled
+    plugin.on_shutdown()
+
+    return dict(trials=trials, bounces=bounces, glitch_ms=glitch_ms,
+                debounce_mode=plugin.setting_debounce_mode,
+                polled=polled,
+                latency_ms=dict(min=min(latencies) if latencies else None,
+                                p50=percentile(latencies, 0.5),
+                                p90=percentile(latencies, 0.9),
+                                p99=percentile(latencies, 0.99),
+                                max=max(latencies) if latencies else None),
+                missed=missed,
+                false_triggers=false_triggers,
+                false_trigger_rate=float(false_triggers) / trials if trials else None)
+
+
+# lines printed after the runout edge with the runout g-code queued behind the send queue or injected in front
+def benchmark_injection(trials, queue_depth, line_interval, settings):
+    results = dict(trials=trials, queue_depth=queue_depth, line_interval_ms=line_interval * 1000)
+    for injection in (False, True):
+        lines = []
+        rejected = 0
+        for trial in range(trials):
+            plugin = create_plugin(dict(settings, pin=PIN, gpio_backend="simulated", runout_injection=injection))
+            printer = plugin._printer = StreamingPrinter(gcode_stream(1000, seed=trial), queue_depth, line_interval)
+            plugin.on_after_startup()
+            plugin.wait_until_ready(5)
+            insert_filament(plugin)
+            plugin.on_event(Events.PRINT_STARTED, {})
+            streamer = printer.start(plugin.sending_gcode, plugin.cached_gcode)
+            time.sleep(0.05)
+            edge_sent = printer.sent
+            plugin.gpio.play(PIN, bounce_script(LEVEL_RUNOUT, seed=trial)).join()
+            if printer.command_event.wait(5):
+                lines.append(printer.action_sent - edge_sent)
+            printer.running = False
+            streamer.join()
+            rejected += printer.rejected
+            plugin.on_event(Events.PRINT_DONE, {})
+            plugin.on_shutdown()
+        results["injected" if injection else "queued"] = dict(lines_p50=percentile(lines, 0.5),
+                                                              lines_max=max(lines) if lines else None,
+                                                              missed=trials - len(lines),
+                                                              rejected_hook_results=rejected)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gcode hook overhead and runout detection latency")
+    parser.add_argument("--lines", type=int, default=200000, help="gcode and response lines streamed through the hooks")
+    parser.add_argument("--repeats", type=int, default=3, help="repetitions of each hook run, the best one counts")
+    parser.add_argument("--trials", type=int, default=20, help="runout edges injected for the latency measurement")
+    parser.add_argument("--bounces", type=int, default=7, help="contact bounces on every injected edge")
+    parser.add_argument("--glitch-ms", type=float, default=5.0, help="length of the injected false trigger glitches")
+    parser.add_argument("--queue-depth", type=int, default=50, help="lines waiting in the send queue")
+    parser.add_argument("--line-ms", type=float, default=2.0, help="time between two lines sent to the printer")
+    parser.add_argument("--debounce-mode", help="override the debounce mode setting")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    settings = dict()
+    if args.debounce_mode:
+        settings["debounce_mode"] = args.debounce_mode
+
+    results = dict(plugin_version=plugin_module.__plugin_version__,
+                   python=platform.python_version(),
+                   platform=platform.platform(),
+                   timestamp=time.time(),
+                   hooks=benchmark_hooks(args.lines, args.repeats),
+                   detection=benchmark_detection(args.trials, args.bounces, args.glitch_ms, settings),
+                   detection_polled=benchmark_detection(args.trials, args.bounces, args.glitch_ms, settings, False),
+                   injection=benchmark_injection(max(1, args.trials // 4), args.queue_depth, args.line_ms / 1000.0,
+                                                 settings))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,32 @@
 from __future__ import absolute_import
 
 import octoprint.plugin
-import re
+import os
+import threading
 from octoprint.events import Events
-from time import sleep
-import RPi.GPIO as GPIO
+from time import sleep, time
 import flask
+from octoprint.util import RepeatedTimer
+
+from . import gpio_backend
+from . import pins
+from .gpio_backend import monotonic
+from .debounce import filter_factory, FILTERS
+from .extrusion import ExtrusionTracker, JamDetector
+from . import history
+from .history import EventLog
+from .metrics import MetricsRegistry
+from .sampler import SensorSampler
+from .sensor import Sensor
+from .status import StatusPublisher
+from . import trace as tracing
+from .trace import TraceBuffer
+from . import workflow
+from .workflow import Workflow
 
 
 class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
+                                       octoprint.plugin.ShutdownPlugin,
                                        octoprint.plugin.EventHandlerPlugin,
                                        octoprint.plugin.TemplatePlugin,
                                        octoprint.plugin.SettingsPlugin,
@@ -25,23 +43,171 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
     # gpio mode disabled
     gpio_mode_disabled = False
 
+    # numbering mode the plugin set itself, a different preset mode was set by a 3rd party
+    gpio_mode_set = None
+
     # printing flag
     printing = False
 
-    gpio_initialized = False
+    # GPIO setup state shown in the settings, the GPIO library is only loaded by the background setup
+    readiness = "starting"
+    readiness_error = None
+
+    # responses of the pin checks, 555 and 556 are not http specific, the settings explain them
+    pin_in_use_status = 555
+    pin_invalid_status = 556
+
+    # how long to wait for the sampler to settle when the filament state is needed right away
+    state_timeout = 5
+
+    # how often to check that nobody else reconfigured our pins, in seconds
+    pin_check_interval = 30
+
+    # the gcode hooks are timed once every hook_sample_mask + 1 lines to keep the overhead low
+    hook_sample_mask = 63
+
+    # events kept in the trace ring buffer
+    trace_size = 1024
+
+    # size of a runout history segment in bytes and segments kept besides the current one
+    history_segment_bytes = 1024 * 1024
+    history_backups = 3
+
+    # shortest time between two filament status pushes to the browsers, in seconds
+    status_interval = 0.5
+
+    # sensor test progress is pushed every this many reads
+    test_progress_reads = 10
+
+    # how long a pin scan watches the pins unless told otherwise and at most, in seconds
+    scan_duration = 5
+    max_scan_duration = 60
+
+    # pin scan progress is pushed at most this often, in seconds
+    scan_progress_interval = 0.5
+
+    # seconds an injected runout action waits for the next line before it is queued the usual way
+    injection_timeout = 2.0
+
+    # bounce time of the encoder pin in ms, encoders pulse a lot faster than switches flip
+    jam_bounce_time = 2
+
+    # delay between reads of sensors without edge detection while printing or changing filament and while idle,
+    # in seconds
+    poll_interval_active = 0.05
+    poll_interval_idle = 5.0
 
     def initialize(self):
-        GPIO.setwarnings(True)
-        # flag defining that the filament change command has been sent to printer, this does not however mean that
-        # filament change sequence has been started
-        self.changing_filament_initiated = False
-        # flag defining that the filament change sequence has been started and the M600 command has been se to printer
-        self.changing_filament_command_sent = False
-        # flag defining that the filament change sequence has been started and the printer is waiting for user
-        # to put in new filament
-        self.paused_for_user = False
-        # flag to prevent double detection
-        self.changing_filament_started = False
+        # every GPIO access goes through the backend so the plugin can run against simulated pins, it is
+        # created by start_gpio on a background thread to keep the library import and pin probing off
+        # OctoPrint's startup
+        self.gpio = None
+        # what the pins of the header can be used for, replaced by the table of the actual board once GPIO is up
+        self.pin_index = pins.pin_index()
+        self.ready_event = threading.Event()
+        self.readiness_lock = threading.Lock()
+        # settings saved while the background setup was running, applied once it is done
+        self.reconfigure_when_ready = False
+        # filament change workflow, from the runout action to the printer asking for and getting new filament
+        self.workflow = Workflow()
+        # background sampler owning the sensor pins, keeps the debounced filament states
+        self.sampler = None
+        # active sensors by pin, used to dispatch edge events
+        self.sensors_by_pin = {}
+        # pull resistor each pin has been set up with, pins are only set up again when this changes
+        self.pin_setup = {}
+        self.pin_check_timer = None
+        # jam detection, the tracker follows the commanded extrusion while an encoder pin is configured
+        self.extrusion = None
+        self.jam_detector = None
+        self.jam_pin = None
+        self.jam_config = None
+        # jam action handed to a worker thread but not sent yet
+        self.jam_action_pending = False
+        # lines passed through the gcode hooks
+        self.sent_lines = 0
+        self.received_lines = 0
+        # runout action waiting to be put in front of the next line sent, see inject_gcode
+        self.pending_injection = None
+        self.injection_timer = None
+        self.injection_lock = threading.Lock()
+        # sent_lines at the edge that led to the runout action on its way to the printer
+        self.runout_edge_line = None
+        # debounce settings the current debounce_factory was created from
+        self.debounce_settings = None
+        self.create_metrics()
+        self.trace = TraceBuffer(self.trace_size)
+        # runouts, filament changes and debounce restarts per print job, kept across restarts
+        self.history = EventLog(os.path.join(self.get_plugin_data_folder(), "history"), self.history_segment_bytes,
+                                self.history_backups, logger=self._logger)
+        # when the printer started waiting for the user to put in new filament
+        self.paused_at = None
+        # sensor test running in the background, only one at a time
+        self.test_lock = threading.Lock()
+        self.test_job = None
+        self.test_jobs_started = 0
+        self.status = StatusPublisher(self.filament_status, self.push_filament_status, self.status_interval)
+        self.cache_settings()
+
+    def create_metrics(self):
+        self.metrics = MetricsRegistry("filamentsensorsimplified_")
+        self.metric_edges = self.metrics.counter("edges_total", "Edges detected on the sensor pin.", "sensor")
+        self.metric_debounce_flips = self.metrics.counter(
+            "debounce_flips_total", "Reads disagreeing with the previous read while debouncing.", "sensor")
+        self.metric_runouts = self.metrics.counter("runouts_total", "Filament runouts the plugin reacted to.",
+                                                   "sensor")
+        self.metric_runout_latency = self.metrics.histogram(
+            "runout_latency_seconds", "Time from the sensor edge to the runout action.", "sensor")
+        self.metric_read_multiple = self.metrics.histogram(
+            "read_sensor_multiple_seconds", "Time spent in debounced one-off sensor reads.")
+        self.metric_read_multiple_flips = self.metrics.counter(
+            "read_sensor_multiple_flips_total", "Reads disagreeing with the previous read in one-off sensor reads.",
+            "pin")
+        self.metric_hooks = self.metrics.histogram(
+            "hook_seconds", "Time spent in the gcode hooks, sampled every %d lines." % (self.hook_sample_mask + 1),
+            "hook")
+        self.metric_runout_lines = self.metrics.histogram(
+            "runout_lines", "Lines sent to the printer between the sensor edge and the runout action.",
+            buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+        self.metric_jams = self.metrics.counter("jams_total", "Filament jams detected by the encoder.")
+        self.metrics.gauge("hook_lines", "Lines passed through the gcode hooks since startup.", "hook",
+                           lambda: dict(sending=self.sent_lines, received=self.received_lines))
+        self.metrics.gauge("filament_present", "1 if the sensor detects filament, 0 if not.", "sensor",
+                           lambda: dict((sensor.name, None if sensor.present is None else int(sensor.present))
+                                        for sensor in self.sensors))
+
+    def create_gpio_backend(self):
+        name = self.setting_gpio_backend
+        if name in gpio_backend.CHARDEV_BACKENDS:
+            return gpio_backend.create_backend(name, chip=self._settings.get(["gpiod_chip"]),
+                                               debounce=int(self._settings.get(["kernel_debounce"])))
+        if name == "daemon":
+            return gpio_backend.create_backend(name, socket_path=self._settings.get(["daemon_socket"]))
+        return gpio_backend.create_backend(name)
+
+    # settings used by the gcode hooks, read once instead of on every line
+    def cache_settings(self):
+        self.cached_gcode = self.setting_gcode
+        self.cached_gcodes = frozenset(sensor.gcode for sensor in self.load_sensors())
+        debounce_settings = (self.setting_debounce_mode, self.setting_debounce_interval, self.setting_debounce_window,
+                             self.setting_debounce_threshold, self.setting_debounce_deadline)
+        # keep the factory when nothing changed so the running sampler doesn't get new filters
+        if debounce_settings != self.debounce_settings:
+            self.debounce_settings = debounce_settings
+            self.debounce_interval = self.setting_debounce_interval / 1000.0
+            self.debounce_factory = self.create_debounce_factory()
+
+    def create_debounce_factory(self):
+        mode = self.setting_debounce_mode
+        if mode not in FILTERS:
+            self._logger.warn("Unknown debounce mode %s, using vote" % mode)
+            mode = "vote"
+        deadline = self.setting_debounce_deadline / 1000.0 if self.setting_debounce_deadline > 0 else None
+        return filter_factory(mode, self.setting_debounce_window, self.setting_debounce_threshold, deadline)
+
+    @property
+    def setting_gpio_backend(self):
+        return self._settings.get(["gpio_backend"])
 
     @property
     def setting_gpio_mode(self):
@@ -67,6 +233,67 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
     def setting_cmd_action(self):
         return int(self._settings.get(["cmd_action"]))
 
+    @property
+    def setting_debounce_mode(self):
+        return self._settings.get(["debounce_mode"])
+
+    @property
+    def setting_debounce_interval(self):
+        return max(1, int(self._settings.get(["debounce_interval"])))
+
+    @property
+    def setting_debounce_window(self):
+        return int(self._settings.get(["debounce_window"]))
+
+    @property
+    def setting_debounce_threshold(self):
+        return int(self._settings.get(["debounce_threshold"]))
+
+    @property
+    def setting_debounce_deadline(self):
+        return int(self._settings.get(["debounce_deadline"]))
+
+    @property
+    def setting_runout_injection(self):
+        return self._settings.get_boolean(["runout_injection"])
+
+    @property
+    def setting_jam_pin(self):
+        return int(self._settings.get(["jam_pin"]))
+
+    @property
+    def setting_jam_power(self):
+        return int(self._settings.get(["jam_power"]))
+
+    @property
+    def setting_jam_mm_per_pulse(self):
+        return float(self._settings.get(["jam_mm_per_pulse"]))
+
+    @property
+    def setting_jam_window(self):
+        return float(self._settings.get(["jam_window"]))
+
+    @property
+    def setting_jam_min_ratio(self):
+        return float(self._settings.get(["jam_min_ratio"]))
+
+    @property
+    def setting_extra_sensors(self):
+        return self._settings.get(["extra_sensors"]) or []
+
+    # all configured sensors, the first one is configured by the top level pin/power/triggered settings
+    def load_sensors(self):
+        sensors = [Sensor(0, "Filament sensor", self.setting_pin, self.setting_power, self.setting_triggered,
+                          self.setting_gcode)]
+        for index, data in enumerate(self.setting_extra_sensors, 1):
+            sensors.append(Sensor.from_settings(index, data, self.setting_gcode))
+        return sensors
+
+    # sensors currently watched by the sampler
+    @property
+    def sensors(self):
+        return [] if self.sampler is None else self.sampler.sensors
+
     # AssetPlugin hook
     def get_assets(self):
         return dict(js=["js/filamentsensorsimplified.js"], css=["css/filamentsensorsimplified.css"])
@@ -78,189 +305,821 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
     # Settings hook
     def get_settings_defaults(self):
         return dict(
+            # rpigpio, gpiod (Linux GPIO character device) or simulated (pins driven in-process, for testing and
+            # benchmarking off a Pi), gpiod_mock runs the gpiod backend against a simulated chip, daemon leaves
+            # GPIO to the sensor daemon shared by the OctoPrint instances on the host
+            gpio_backend="rpigpio",
+            # character device of the GPIO chip and kernel debounce period in ms used by the gpiod backend
+            gpiod_chip="/dev/gpiochip0",
+            kernel_debounce=10,
+            # Unix socket of the sensor daemon
+            daemon_socket=gpio_backend.DEFAULT_SOCKET,
             gpio_mode=10,
             pin=0,  # Default is 0
             power=0,
             g_code=self.default_gcode,
             triggered=0,
-            cmd_action=0
+            cmd_action=0,
+            # put the runout g-code in front of the lines already queued instead of behind them
+            runout_injection=False,
+            # additional sensors, e.g. one per extruder, list of dicts with name, pin, power, triggered and g_code
+            extra_sensors=[],
+            # debounce filter: consecutive, majority, integrator or vote
+            debounce_mode="vote",
+            # delay between reads while debouncing in ms
+            debounce_interval=10,
+            # number of reads considered by the filter
+            debounce_window=9,
+            # reads that have to agree in vote mode
+            debounce_threshold=6,
+            # time in ms after which the filter has to decide, 0 = no limit
+            debounce_deadline=250,
+            # pin of a motion sensor (encoder) pulsing while the filament moves, 0 = no jam detection
+            jam_pin=0,
+            jam_power=0,
+            # filament length per encoder pulse in mm
+            jam_mm_per_pulse=2.88,
+            # commanded extrusion in mm the measured movement is compared against
+            jam_window=20,
+            # fraction of the commanded extrusion that has to be measured
+            jam_min_ratio=0.3
         )
 
     # simpleApiPlugin
     def get_api_commands(self):
-        return dict(testSensor=["pin", "power"])
+        return dict(testSensor=["pin", "power"], scanPins=["mode", "power"])
 
     @octoprint.plugin.BlueprintPlugin.route("/disable", methods=["GET"])
     def get_disable(self):
         self._logger.debug("getting gpio disabled by other plugins info")
         gpio_mode_disabled = self.gpio_mode_disabled
-        return flask.jsonify(gpio_mode_disabled=gpio_mode_disabled, printing=self.printing)
+        return flask.jsonify(gpio_mode_disabled=gpio_mode_disabled, printing=self.printing,
+                             readiness=self.readiness, error=self.readiness_error, status=self.status.snapshot())
+
+    # input pins, pull-up quirks and power/ground pins of the board for the settings UI
+    @octoprint.plugin.BlueprintPlugin.route("/pins", methods=["GET"])
+    def get_pins(self):
+        return flask.jsonify(self.pin_index.to_dict())
+
+    # last known filament status for clients that just connected, does not read the sensors
+    @octoprint.plugin.BlueprintPlugin.route("/status", methods=["GET"])
+    def get_status(self):
+        return flask.jsonify(self.status.snapshot())
+
+    # runout counters, latencies and sensor health in the Prometheus text format
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics(self):
+        return flask.Response(self.metrics.render(), content_type=self.metrics.content_type)
+
+    # print jobs with their runout counts and operator response times, newest first, or the events of one job
+    @octoprint.plugin.BlueprintPlugin.route("/history", methods=["GET"])
+    def get_history(self):
+        job = flask.request.values.get("job", type=int)
+        if job is None:
+            limit = flask.request.values.get("limit", type=int)
+            return flask.jsonify(jobs=self.history.jobs(limit))
+        events = self.history.events(job)
+        if events is None:
+            return flask.make_response("Unknown job", 404)
+        return flask.jsonify(job=job, events=events)
+
+    # latest sensor and hook events from the trace ring buffer, oldest first
+    @octoprint.plugin.BlueprintPlugin.route("/trace", methods=["GET"])
+    def get_trace(self):
+        limit = flask.request.values.get("limit", type=int)
+        return flask.jsonify(size=self.trace.size, events=self.trace.dump(limit))
 
     # test pin value, power pin or if its used by someone else
     def on_api_command(self, command, data):
+        if command == "scanPins":
+            return self.scan_pins_command(data)
         try:
             selected_power = int(data.get("power"))
             selected_pin = int(data.get("pin"))
             mode = int(data.get("mode"))
             triggered_mode = int(data.get("triggered"))
 
-            if selected_pin is 0:
-                return "", 556
-
-            self.init_gpio(mode, selected_pin, selected_power, triggered_mode, True)
-            triggered_int = self.is_filament_present(selected_pin, selected_power, triggered_mode)
-            self.init_gpio(self.setting_gpio_mode, self.setting_pin, self.setting_power, self.setting_triggered, True)
-            return flask.jsonify(triggered=triggered_int)
+            if selected_pin == 0:
+                return "", self.pin_invalid_status
+
+            if self.readiness != "ready":
+                # GPIO still being set up in the background or failed to
+                return "", 503
+
+            # sensor under test is one of the active ones, answer from the sampler
+            if mode == self.setting_gpio_mode:
+                for sensor in self.sensors:
+                    if sensor.config == (selected_pin, selected_power, triggered_mode) and sensor.present is not None:
+                        return flask.jsonify(triggered=0 if sensor.present else 1)
+
+            # the test runs against the live GPIO setup so runout detection keeps working, the pin is
+            # translated to the numbering already in use instead of setting the mode again
+            active_mode = self.gpio.getmode()
+            if active_mode is None:
+                self.set_gpio_mode(mode)
+                active_mode = mode
+            pin = self.pin_index.convert(selected_pin, mode, active_mode)
+            if pin is None:
+                return "", self.pin_invalid_status
+            error = self.check_pin(active_mode, pin)
+            if error is not None:
+                return error
+            sensor = self.sensors_by_pin.get(pin)
+            if sensor is not None and sensor.power != selected_power:
+                # the pull resistor of a live sensor can't be switched for a test
+                return "", self.pin_in_use_status
+            job = self.start_test_job(pin, selected_power, triggered_mode)
+            if job is None:
+                # another test is still running
+                return "", 409
+            return flask.jsonify(job=job)
         except ValueError as e:
             self._logger.error(str(e))
             # ValueError occurs when reading from power, ground or out of range pins
-            return "", 556
+            return "", self.pin_invalid_status
+
+    # reads the pin on a worker thread, progress and result are pushed to the browsers as testSensor messages
+    def start_test_job(self, pin, power, triggered_mode):
+        with self.test_lock:
+            if self.test_job is not None:
+                return None
+            self.test_jobs_started += 1
+            job = self.test_job = self.test_jobs_started
+        worker = threading.Thread(target=self.run_test_job, args=(job, pin, power, triggered_mode),
+                                  name="filamentsensorsimplified-test")
+        worker.daemon = True
+        worker.start()
+        return job
+
+    def run_test_job(self, job, pin, power, triggered_mode):
+        def progress(reads, flips):
+            self.send_test_message(job, reads=reads, flips=flips)
 
-    def is_filament_present(self, pin, power, triggered_mode):
-        if self.read_sensor_multiple(pin, power, triggered_mode):
-            self._logger.info("Filament detected")
+        try:
+            result = dict(triggered=self.is_filament_present(pin, power, triggered_mode, progress))
+        except (RuntimeError, ValueError) as e:
+            self._logger.error(str(e))
+            result = dict(error=self.pin_invalid_status)
+        except Exception:
+            self._logger.exception("Sensor test failed")
+            result = dict(error=500)
+        finally:
+            self.release_pin(pin)
+        with self.test_lock:
+            self.test_job = None
+        self.send_test_message(job, done=True, **result)
+
+    # watches every free input pin of the selected mode at once, the pins changing state while the user inserts and
+    # removes filament are pushed as scanPins messages. Pins with a note in the pin table (UART, I2C, HAT EEPROM)
+    # are only watched when asked for with "all".
+    def scan_pins_command(self, data):
+        try:
+            include_all = bool(data.get("all", False))
+            power = int(data.get("power"))
+            mode = int(data.get("mode"))
+            triggered_mode = int(data.get("triggered", 0))
+            duration = min(float(data.get("duration", self.scan_duration)), self.max_scan_duration)
+        except (TypeError, ValueError) as e:
+            self._logger.error(str(e))
+            return "", 400
+
+        if self.readiness != "ready":
+            return "", 503
+
+        active_mode = self.gpio.getmode()
+        if active_mode is None:
+            self.set_gpio_mode(mode)
+            active_mode = mode
+        # (pin as the user numbers it, pin in the mode in use)
+        pins = []
+        for selected_pin in self.pin_index.input_pins(mode):
+            if not include_all and self.pin_index.lookup(mode, selected_pin).note:
+                continue
+            pin = self.pin_index.convert(selected_pin, mode, active_mode)
+            if pin is None or pin == self.jam_pin:
+                continue
+            sensor = self.sensors_by_pin.get(pin)
+            if sensor is not None and sensor.power != power:
+                # the pull resistor of a live sensor can't be switched for a scan
+                continue
+            if self.check_pin(active_mode, pin) is None:
+                pins.append((selected_pin, pin))
+        if not pins:
+            return "", self.pin_invalid_status
+
+        with self.test_lock:
+            if self.test_job is not None:
+                return "", 409
+            self.test_jobs_started += 1
+            job = self.test_job = self.test_jobs_started
+        worker = threading.Thread(target=self.run_scan_job, args=(job, pins, power, triggered_mode, duration),
+                                  name="filamentsensorsimplified-scan")
+        worker.daemon = True
+        worker.start()
+        return flask.jsonify(job=job, pins=[selected_pin for selected_pin, pin in pins], duration=duration)
+
+    def run_scan_job(self, job, pins, power, triggered_mode, duration):
+        present = {}
+        changes = dict((selected_pin, 0) for selected_pin, pin in pins)
+        sweeps = 0
+        try:
+            start = monotonic()
+            next_progress = start + self.scan_progress_interval
+            # one sweep reads every pin, the sweeps are spaced like the reads of a sensor test
+            while True:
+                for selected_pin, pin in pins:
+                    try:
+                        value = self.read_sensor(pin, power, triggered_mode)
+                    except (RuntimeError, ValueError):
+                        continue
+                    if selected_pin in present and present[selected_pin] != value:
+                        changes[selected_pin] += 1
+                    present[selected_pin] = value
+                sweeps += 1
+                now = monotonic()
+                if now - start >= duration:
+                    break
+                if now >= next_progress:
+                    next_progress = now + self.scan_progress_interval
+                    self.send_scan_message(job, sweeps=sweeps, changed=self.changed_pins(changes))
+                sleep(self.debounce_interval)
+            result = dict(changed=self.changed_pins(changes),
+                          pins=[dict(pin=selected_pin, present=present.get(selected_pin)) for selected_pin, pin in pins])
+        except Exception:
+            self._logger.exception("Pin scan failed")
+            result = dict(error=500)
+        finally:
+            for selected_pin, pin in pins:
+                self.release_pin(pin)
+        with self.test_lock:
+            self.test_job = None
+        self._logger.info("Pin scan done after %d sweeps over %d pins" % (sweeps, len(pins)))
+        self.send_scan_message(job, done=True, sweeps=sweeps, **result)
+
+    # pins that changed state with their number of changes, most changes first
+    @staticmethod
+    def changed_pins(changes):
+        changed = [dict(pin=pin, changes=count) for pin, count in changes.items() if count]
+        changed.sort(key=lambda item: (-item["changes"], item["pin"]))
+        return changed
+
+    def send_scan_message(self, job, **kwargs):
+        self._plugin_manager.send_plugin_message(self._identifier, dict(kwargs, type="scanPins", job=job))
+
+    def send_test_message(self, job, **kwargs):
+        self._plugin_manager.send_plugin_message(self._identifier, dict(kwargs, type="testSensor", job=job))
+
+    def is_filament_present(self, pin, power, triggered_mode, progress=None):
+        if self.read_sensor_multiple(pin, power, triggered_mode, progress):
             return 0
         else:
-            self._logger.info("Filament not detected")
             return 1
 
     def show_printer_runout_popup(self):
         self._plugin_manager.send_plugin_message(self._identifier,
                                                  dict(type="error", autoClose=False, msg="Printer ran out of filament!"))
 
-    def send_out_of_filament(self):
-        self.show_printer_runout_popup()
-        if self.setting_cmd_action is 0:
-            self._logger.info("Sending out of filament GCODE: %s" % (self.setting_gcode))
-            self._printer.commands(self.setting_gcode)
-            self.changing_filament_initiated = True
-        elif self.setting_cmd_action is 1:
+    # edge_line is sent_lines at the sensor edge, lines sent from then until the action are reported. Returns
+    # whether an action was taken, False when another runout got there first.
+    def send_out_of_filament(self, sensor=None, edge_line=None):
+        if self.setting_cmd_action == 0:
+            # only one runout action per filament change, whichever thread gets here first sends it
+            if self.workflow.fire(workflow.RUNOUT) is None:
+                self._logger.debug("Filament change already in progress (%s)" % self.workflow.state)
+                return False
+            self.show_printer_runout_popup()
+            gcode = self.cached_gcode if sensor is None else sensor.gcode
+            self._logger.info("Sending out of filament GCODE: %s" % (gcode))
+            self.runout_edge_line = self.sent_lines if edge_line is None else edge_line
+            # the sending hook can only replace one line with one line
+            if self.setting_runout_injection and self.printing and "\n" not in gcode.strip():
+                self.inject_gcode(gcode)
+            else:
+                self._printer.commands(gcode)
+            return True
+        elif self.setting_cmd_action == 1:
+            self.show_printer_runout_popup()
             self._logger.info("Pausing print using OctoPrint native pause")
             self._printer.commands('G1 X0 Y0')
             self._printer.pause_print()
+            return True
+        return False
 
-    def sensor_callback(self, _):
-        self._logger.info("Sensor callback called")
-        filamentPresentInt = self.is_filament_present(self.setting_pin, self.setting_power, self.setting_triggered)
-        if filamentPresentInt is 1:
-            self._logger.info("Sensor was triggered")
-            if not self.changing_filament_initiated and self.printing:
-                self.send_out_of_filament()
+    # the sending hook puts the gcode in front of the next line instead of queueing it behind everything
+    # OctoPrint already has in its send queue, if no line comes along in time it is queued after all
+    def inject_gcode(self, gcode):
+        with self.injection_lock:
+            if self.injection_timer is not None:
+                self.injection_timer.cancel()
+            self.pending_injection = gcode
+            self.injection_timer = threading.Timer(self.injection_timeout, self.flush_injection)
+            self.injection_timer.daemon = True
+            self.injection_timer.start()
+
+    def claim_injection(self):
+        with self.injection_lock:
+            gcode, self.pending_injection = self.pending_injection, None
+            if self.injection_timer is not None:
+                self.injection_timer.cancel()
+                self.injection_timer = None
+        return gcode
+
+    def flush_injection(self):
+        gcode = self.claim_injection()
+        if gcode is not None:
+            self._logger.info("No line sent within %s s, queueing %s" % (self.injection_timeout, gcode))
+            self._printer.commands(gcode)
+
+    def report_runout_lines(self, sent_lines):
+        edge_line = self.runout_edge_line
+        if edge_line is None:
+            return
+        self.runout_edge_line = None
+        lines = max(0, sent_lines - edge_line)
+        self.metric_runout_lines.observe(lines)
+        self.trace.record(tracing.HOOK, "sending", "runout action after %d lines" % lines)
+        self._logger.info("Runout action sent to the printer %d lines after the sensor edge" % lines)
+
+    # edge detected on one of the sensor pins, let the sampler settle the new state of that sensor
+    # timestamp is the time of the edge on the monotonic clock, taken by the kernel with the gpiod backend
+    def sensor_callback(self, channel, timestamp=None):
+        sensor = self.sensors_by_pin.get(channel)
+        if sensor is not None and self.sampler is not None:
+            sensor.edge_time = monotonic() if timestamp is None else timestamp
+            sensor.edge_line = self.sent_lines
+            self.trace.record(tracing.EDGE, sensor.name)
+            self.metric_edges.inc(1, sensor.name)
+            self.sampler.poke(sensor, edge=True)
+
+    # called by the sampler whenever the debounced filament state of a sensor changes
+    def filament_state_changed(self, sensor, state):
+        if not state.present:
+            self._logger.info("%s was triggered" % sensor.name)
+            if self.workflow.idle and self.printing and self.send_out_of_filament(sensor, sensor.edge_line):
+                sensor.edge_line = None
+                self.metric_runouts.inc(1, sensor.name)
+                latency = None
+                if sensor.edge_time is not None:
+                    latency = monotonic() - sensor.edge_time
+                    self.metric_runout_latency.observe(latency, sensor.name)
+                    self.trace.record(tracing.RUNOUT, sensor.name, latency)
+                    self._logger.info("Runout action sent %.1f ms after the sensor edge" % (latency * 1000))
+                    sensor.edge_time = None
+                self.history.record(history.RUNOUT, -1 if latency is None else latency * 1000, sensor.index)
             # change navbar icon to filament runout
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="filamentStatus", noFilament=True,
-                                                                            msg="Printer ran out of filament!"))
-        elif filamentPresentInt is 0:
-            self._logger.info("Sensor was not triggered")
+            self.send_filament_status("%s ran out of filament!" % sensor.name)
+        else:
+            self._logger.info("%s was not triggered" % sensor.name)
             # change navbar icon to filament present
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="filamentStatus", noFilament=False,
-                                                                            msg="Filament inserted!"))
-
-    def init_gpio(self, gpio_mode, pin, power, trigger_mode, test):
+            self.send_filament_status("Filament inserted!")
+
+    # pushes of the same state and bursts of changes are coalesced by the status publisher
+    def send_filament_status(self, msg):
+        self.status.update(msg)
+
+    def filament_status(self):
+        sensors = [sensor.to_dict() for sensor in self.sensors]
+        return dict(noFilament=any(sensor["noFilament"] for sensor in sensors), sensors=sensors)
+
+    def push_filament_status(self, payload):
+        self._plugin_manager.send_plugin_message(self._identifier, dict(payload, type="filamentStatus"))
+
+    # cached filament state of all sensors, waits for the sampler only while a sensor has not settled yet
+    # returns False if any sensor is out of filament, None when a state is unknown
+    def filament_present(self, newer_than=None):
+        if self.sampler is None:
+            return None
+        present = True
+        for sensor in self.sensors:
+            state = sensor.state
+            if state is None or (newer_than is not None and state.timestamp <= newer_than):
+                state = self.sampler.wait_for_state(sensor, newer_than, self.state_timeout)
+            if state is None:
+                present = None
+            elif not state.present:
+                return False
+        return present
+
+    # first sensor reporting no filament
+    def runout_sensor(self):
+        for sensor in self.sensors:
+            if sensor.present is False:
+                return sensor
+        return None
+
+    def start_sampler(self, sensors):
+        self.stop_sampler()
+        self.sampler = SensorSampler(self.filament_state_changed, self._logger, self.debounce_factory,
+                                     self.debounce_interval, self.metric_debounce_flips, self.trace,
+                                     self.poll_interval, self.debounce_restarted)
+        for sensor in sensors:
+            self.sampler.add(sensor, self.sensor_reader(sensor))
+        self.sampler_settings = (self.debounce_factory, self.debounce_interval)
+        self.sampler.start()
+
+    def debounce_restarted(self, sensor):
+        self.history.record(history.DEBOUNCE_RESTART, sensor=sensor.index)
+
+    # sensors without edge detection are polled fast only while a runout matters
+    def poll_interval(self):
+        if self.printing or not self.workflow.idle:
+            return self.poll_interval_active
+        return self.poll_interval_idle
+
+    def update_polling(self):
+        sampler = self.sampler
+        if sampler is not None and any(sensor.polled for sensor in sampler.sensors):
+            sampler.reschedule()
+
+    def sensor_reader(self, sensor):
+        return lambda: self.read_sensor(sensor.pin, sensor.power, sensor.triggered)
+
+    def stop_sampler(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    # returns None if the pin can be used for a sensor, otherwise the response describing the problem
+    def check_pin(self, gpio_mode, pin):
+        # power, ground and out of range pins are known from the pin index
+        if not self.pin_index.valid(gpio_mode, pin):
+            return "", self.pin_invalid_status
+        # whether another program took the pin only GPIO knows, checked right before the pin is used
+        try:
+            usage = self.gpio.gpio_function(pin)
+        except (RuntimeError, ValueError) as e:
+            self._logger.error(str(e))
+            return "", self.pin_invalid_status
+        self._logger.debug("usage on pin %s is %s" % (pin, usage))
+        if usage != gpio_backend.IN:
+            return "", self.pin_in_use_status
+        return None
+
+    # 0 = sensor is grounded, react to rising edge pulled up by pull up resistor
+    # 1 = sensor is powered, react to falling edge pulled down by pull down resistor
+    # switches triggered when closed react to the opposite edge
+    def sensor_edge(self, sensor):
+        if (sensor.power + sensor.triggered) % 2 == 0:
+            return gpio_backend.RISING
+        return gpio_backend.FALLING
+
+    def remove_event_detection(self):
+        pins, self.sensors_by_pin = self.sensors_by_pin, {}
+        for pin in pins:
+            self.remove_edge_detection(pin)
+            self.release_pin(pin)
+
+    def set_gpio_mode(self, gpio_mode):
+        self.gpio.setmode(gpio_mode)
+        self.gpio_mode_set = gpio_mode
+
+    def init_gpio(self, gpio_mode, sensors, test):
         self._logger.info("Initializing GPIO.")
-        preset_gpio_mode = GPIO.getmode()
-        if preset_gpio_mode is not None:
+        preset_gpio_mode = self.gpio.getmode()
+        if preset_gpio_mode is not None and preset_gpio_mode != self.gpio_mode_set:
             self.gpio_mode_disabled = True
+        if self.gpio_mode_disabled and preset_gpio_mode is not None:
             gpio_mode = preset_gpio_mode
             self._settings.set(["gpio_mode"], preset_gpio_mode)
         else:
             self._logger.info("Preset mode is %s" % preset_gpio_mode)
 
-        # Fix old -1 settings to 0
-        if pin is -1:
-            self._logger.debug("Fixing old settings from -1 to 0")
-            self._settings.set(["pin"], 0)
+        if not test:
+            self.stop_sampler()
+            self.remove_event_detection()
 
-        if self.plugin_enabled(pin):
-            self._logger.info("Enabling filament sensor.")
-            self._logger.info("Mode is %s" % gpio_mode)
-            # BOARD
-            if gpio_mode is 10:
-                # if mode set by 3rd party don't set it again
-                if not self.gpio_mode_disabled:
-                    self._logger.info("Setting Board mode")
-                    GPIO.cleanup()
-                    GPIO.setmode(GPIO.BOARD)
-                # first check pins not in use already
-                usage = GPIO.gpio_function(pin)
-                self._logger.debug("usage on pin %s is %s" % (pin, usage))
-                # 1 = input
-                if usage is not 1:
-                    # 555 is not http specific so I chose it
-                    return "", 555
-            # BCM
-            elif gpio_mode is 11:
-                # BCM range 1-27
-                if pin > 27:
-                    return "", 556
-                # if mode set by 3rd party don't set it again
-                if not self.gpio_mode_disabled:
-                    self._logger.debug("Setting BCM mode")
-                    GPIO.cleanup()
-                    GPIO.setmode(GPIO.BCM)
-            if not test:
-                try:
-                    # 0 = sensor is grounded, react to rising edge pulled up by pull up resistor
-                    if power is 0:
-                        self.pull_resistor(pin, power)
-                        # triggered when open
-                        if trigger_mode is 0:
-                            self._logger.debug("Reacting to rising edge")
-                            GPIO.add_event_detect(
-                                pin, GPIO.RISING,
-                                callback=self.sensor_callback,
-                                bouncetime=self.bounce_time)
-                        # triggered when closed
-                        else:
-                            self._logger.debug("Reacting to falling edge")
-                            GPIO.add_event_detect(
-                                pin, GPIO.FALLING,
-                                callback=self.sensor_callback,
-                                bouncetime=self.bounce_time)
-
-                    # 1 = sensor is powered, react to falling edge pulled down by pull down resistor
-                    else:
-                        self.pull_resistor(pin, power)
-                        # triggered when open
-                        if trigger_mode is 0:
-                            self._logger.debug("Reacting to falling edge")
-                            GPIO.add_event_detect(
-                                pin, GPIO.FALLING,
-                                callback=self.sensor_callback,
-                                bouncetime=self.bounce_time)
-                        # triggered when closed
-                        else:
-                            self._logger.debug("Reacting to rising edge")
-                            GPIO.add_event_detect(
-                                pin, GPIO.RISING,
-                                callback=self.sensor_callback,
-                                bouncetime=self.bounce_time)
-                except RuntimeError as e:
-                    self._logger.warn(str(e))
-        else:
+        sensors = [sensor for sensor in sensors if self.plugin_enabled(sensor.pin)]
+        # the numbering changed on save, the encoder is set up again in the new mode too
+        mode_changed = preset_gpio_mode is not None and preset_gpio_mode != gpio_mode
+        if not sensors and not (mode_changed and not self.gpio_mode_disabled):
+            self._logger.info("Sensor disabled")
+            return None
+
+        self._logger.info("Mode is %s" % gpio_mode)
+        # if mode set by 3rd party don't set it again
+        if not self.gpio_mode_disabled:
+            # cleanup() drops the encoder pin as well, setup_jam_detection sets it up again
+            self.release_jam_pin()
+            self.gpio.cleanup()
+            self.pin_setup = {}
+            self.gpio_mode_set = None
+            if gpio_mode == 10:
+                self._logger.info("Setting Board mode")
+                self.set_gpio_mode(gpio_backend.BOARD)
+            elif gpio_mode == 11:
+                self._logger.debug("Setting BCM mode")
+                self.set_gpio_mode(gpio_backend.BCM)
+        if not sensors:
             self._logger.info("Sensor disabled")
+            return None
+
+        self._logger.info("Enabling filament sensor.")
+
+        usable = []
+        for sensor in sensors:
+            error = self.check_pin(gpio_mode, sensor.pin)
+            if error is not None:
+                if test:
+                    return error
+                self.pin_unusable(sensor.name, sensor.pin)
+            else:
+                usable.append(sensor)
+        if test:
+            return None
+
+        for sensor in usable:
+            self.pull_resistor(sensor.pin, sensor.power)
+            self.add_edge_detection(sensor)
+            self.sensors_by_pin[sensor.pin] = sensor
+        self.start_sampler(usable)
+        return None
+
+    # settings are only checked against the pin index when saved, a pin taken by someone else shows up here
+    def pin_unusable(self, name, pin):
+        self._logger.warn("%s: pin %s can't be used" % (name, pin))
+        self._plugin_manager.send_plugin_message(self._identifier, dict(
+            type="error", autoClose=True, msg="%s: pin %s is used by others or can't be used, choose another pin"
+                                              % (name, pin)))
+
+    def add_edge_detection(self, sensor):
+        try:
+            self.gpio.add_event_detect(sensor.pin, self.sensor_edge(sensor), self.sensor_callback, self.bounce_time)
+            sensor.polled = False
+        except RuntimeError as e:
+            # e.g. edge detection not supported by the kernel, the sampler polls the pin instead
+            self._logger.warn("%s: edge detection on pin %s failed, polling the pin instead: %s"
+                              % (sensor.name, sensor.pin, e))
+            sensor.polled = True
+            self.update_polling()
+
+    def remove_edge_detection(self, pin):
+        try:
+            self.gpio.remove_event_detect(pin)
+        except (RuntimeError, ValueError) as e:
+            self._logger.debug("Removing event detection on pin %s failed: %s" % (pin, e))
+
+    # (re)starts jam detection from the settings, the encoder pin is only set up again when it changed
+    def setup_jam_detection(self):
+        pin = self.setting_jam_pin
+        config = (pin, self.setting_jam_power)
+        if self.jam_pin is not None and (self.jam_config != config or self.gpio.getmode() is None):
+            self.release_jam_pin()
+        self.jam_config = config
+        if not self.plugin_enabled(pin):
+            self.jam_detector = None
+            self.extrusion = None
+            return
+
+        if self.jam_pin is None:
+            gpio_mode = self.gpio.getmode()
+            if gpio_mode is None:
+                # no runout sensor set the mode up
+                gpio_mode = self.setting_gpio_mode
+                self.set_gpio_mode(gpio_mode)
+            if self.check_pin(gpio_mode, pin) is not None:
+                self.pin_unusable("Jam detection", pin)
+                self.jam_detector = None
+                self.extrusion = None
+                return
+            self.pull_resistor(pin, self.setting_jam_power)
+            try:
+                self.gpio.add_event_detect(pin, gpio_backend.RISING, self.jam_callback, self.jam_bounce_time)
+            except RuntimeError as e:
+                self._logger.warn(str(e))
+            self.jam_pin = pin
+
+        if self.extrusion is None:
+            self.extrusion = ExtrusionTracker()
+        self.jam_detector = JamDetector(self.extrusion, self.setting_jam_mm_per_pulse, self.setting_jam_window,
+                                        self.setting_jam_min_ratio)
+
+    def release_jam_pin(self):
+        pin, self.jam_pin = self.jam_pin, None
+        if pin is not None:
+            self.remove_edge_detection(pin)
+            self.release_pin(pin)
+
+    # encoder pulse
+    def jam_callback(self, channel, timestamp=None):
+        detector = self.jam_detector
+        if detector is not None:
+            detector.pulse()
+
+    def reset_jam_detection(self):
+        if self.jam_detector is not None:
+            self.jam_detector.reset()
+
+    def check_jam(self):
+        detector = self.jam_detector
+        if detector is None:
+            return
+        jam = detector.check()
+        if jam is None or not self.printing or not self.workflow.idle or self.jam_action_pending:
+            return
+        commanded, measured = jam
+        self._logger.info("Filament jam: %.1f mm extruded but only %.1f mm moved" % (commanded, measured))
+        self.trace.record(tracing.JAM, "encoder", jam)
+        self.metric_jams.inc()
+        detector.reset()
+        self.jam_action_pending = True
+        # never send commands from within the sending hook
+        worker = threading.Thread(target=self.send_jam_action, args=(commanded, measured),
+                                  name="filamentsensorsimplified-jam")
+        worker.daemon = True
+        worker.start()
+
+    def send_jam_action(self, commanded, measured):
+        self.jam_action_pending = False
+        if not self.workflow.idle:
+            return
+        self._plugin_manager.send_plugin_message(self._identifier, dict(
+            type="error", autoClose=False,
+            msg="Filament jam detected: %.1f mm extruded but the filament only moved %.1f mm" % (commanded, measured)))
+        self.send_out_of_filament()
+
+    # applies saved sensor settings to the running setup touching only what changed: pins get their pull
+    # resistor switched or their edge detection swapped, new pins are detected before old ones are dropped
+    # so there is no moment without runout detection. Falls back to init_gpio when the numbering mode
+    # changes or nothing was running yet.
+    def reconfigure_gpio(self, gpio_mode, sensors):
+        active_mode = self.gpio.getmode()
+        if self.sampler is None or active_mode is None or (not self.gpio_mode_disabled and active_mode != gpio_mode):
+            return self.init_gpio(gpio_mode, sensors, False)
+        if active_mode != gpio_mode:
+            # numbering mode set by someone else, keep using it like init_gpio does
+            self._settings.set(["gpio_mode"], active_mode)
+
+        sampler = self.sampler
+        running = dict((sensor.index, sensor) for sensor in sampler.sensors)
+        old_pins = self.sensors_by_pin
+        new_pins = {}
+        for sensor in sensors:
+            if not self.plugin_enabled(sensor.pin):
+                continue
+            if self.check_pin(active_mode, sensor.pin) is not None:
+                self.pin_unusable(sensor.name, sensor.pin)
+                continue
+            current = running.get(sensor.index)
+            if current is not None and current.config == sensor.config:
+                # same hardware, keep the sensor and its debounced state
+                current.name = sensor.name
+                current.gcode = sensor.gcode
+                sensor = current
+            new_pins[sensor.pin] = sensor
+
+        for pin, sensor in new_pins.items():
+            old = old_pins.get(pin)
+            if old is None:
+                self.pull_resistor(pin, sensor.power)
+                self.add_edge_detection(sensor)
+                continue
+            if old.power != sensor.power:
+                self.pull_resistor(pin, sensor.power)
+            if self.sensor_edge(old) != self.sensor_edge(sensor):
+                self.remove_edge_detection(pin)
+                self.add_edge_detection(sensor)
+        self.sensors_by_pin = new_pins
+        for pin in old_pins:
+            if pin not in new_pins:
+                self.remove_edge_detection(pin)
+                self.release_pin(pin)
+
+        if self.sampler_settings != (self.debounce_factory, self.debounce_interval):
+            sampler.configure(self.debounce_factory, self.debounce_interval)
+        for sensor in running.values():
+            if new_pins.get(sensor.pin) is not sensor:
+                sampler.remove(sensor)
+        for sensor in new_pins.values():
+            if running.get(sensor.index) is not sensor:
+                sampler.add(sensor, self.sensor_reader(sensor))
+                sampler.poke(sensor)
+        self.sampler_settings = (self.debounce_factory, self.debounce_interval)
+        if not new_pins:
+            self.stop_sampler()
+        # sensors that went away disappear from the navbar
+        self.send_filament_status("Sensors reconfigured")
+        return None
 
     # pulls resistor up or down based on the parameters
     def pull_resistor(self, pin, power):
-        if power is 0:
+        if power == 0:
             self._logger.debug("Pulling up resistor")
-            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        elif power is 1:
+            self.gpio.setup_input(pin, gpio_backend.PUD_UP)
+            self.pin_setup[pin] = gpio_backend.PUD_UP
+        elif power == 1:
             self._logger.debug("Pulling down resistor")
-            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+            self.gpio.setup_input(pin, gpio_backend.PUD_DOWN)
+            self.pin_setup[pin] = gpio_backend.PUD_DOWN
         self._logger.debug("Done")
 
+    # sets the pin up only if it isn't set up with the right pull resistor already
+    def ensure_input(self, pin, power):
+        if self.pin_setup.get(pin) != (gpio_backend.PUD_UP if power == 0 else gpio_backend.PUD_DOWN):
+            self.pull_resistor(pin, power)
+
+    # gives back a pin set up for a sensor test or pin scan, pins of live sensors and the encoder stay set up
+    def release_pin(self, pin):
+        if pin in self.sensors_by_pin or pin == self.jam_pin:
+            return
+        self.pin_setup.pop(pin, None)
+        try:
+            self.gpio.release(pin)
+        except (RuntimeError, ValueError) as e:
+            self._logger.debug("Releasing pin %s failed: %s" % (pin, e))
+
+    # forgets pins another plugin switched to a different function, they are set up again on the next read
+    def check_pins(self):
+        for pin in list(self.pin_setup):
+            try:
+                usage = self.gpio.gpio_function(pin)
+            except (RuntimeError, ValueError) as e:
+                usage = str(e)
+            if usage != gpio_backend.IN:
+                self._logger.warn("Pin %s has been reconfigured by someone else (%s), setting it up again" % (pin, usage))
+                self.pin_setup.pop(pin, None)
+
+    def start_pin_check(self):
+        if self.pin_check_timer is None:
+            self.pin_check_timer = RepeatedTimer(self.pin_check_interval, self.check_pins, daemon=True)
+            self.pin_check_timer.start()
+
+    def stop_pin_check(self):
+        if self.pin_check_timer is not None:
+            self.pin_check_timer.cancel()
+            self.pin_check_timer = None
+
     def on_after_startup(self):
         self._logger.info("Filament Sensor Simplified started")
-        self.init_gpio(self.setting_gpio_mode, self.setting_pin, self.setting_power, self.setting_triggered, False)
-        self.gpio_initialized = True
+        # Fix old -1 settings to 0
+        if self.setting_pin == -1:
+            self._logger.debug("Fixing old settings from -1 to 0")
+            self._settings.set(["pin"], 0)
+        self.start_gpio_setup()
+
+    # GPIO library import, cleanup/setmode and pin probing run on a worker thread, the readiness state tells
+    # the UI when the sensors are live
+    def start_gpio_setup(self):
+        self.set_readiness("starting")
+        worker = threading.Thread(target=self.start_gpio, name="filamentsensorsimplified-init")
+        worker.daemon = True
+        worker.start()
+
+    def start_gpio(self):
+        try:
+            self.gpio = self.create_gpio_backend()
+            self.gpio.setwarnings(True)
+            self.pin_index = pins.pin_index(self.gpio.board_revision())
+            self.init_gpio(self.setting_gpio_mode, self.load_sensors(), False)
+            self.setup_jam_detection()
+        except Exception as e:
+            self._logger.exception("Setting up GPIO failed")
+            self.set_readiness("failed", str(e))
+            return
+        self.start_pin_check()
+        while True:
+            with self.readiness_lock:
+                reconfigure, self.reconfigure_when_ready = self.reconfigure_when_ready, False
+                if not reconfigure:
+                    # saves from now on apply their settings themselves
+                    self.readiness = "ready"
+                    break
+            # settings saved meanwhile may not have been picked up by the setup
+            self.apply_settings()
+        self.set_readiness("ready")
+
+    def set_readiness(self, readiness, error=None):
+        with self.readiness_lock:
+            self.readiness = readiness
+            self.readiness_error = error
+            if readiness == "starting":
+                self.ready_event.clear()
+            else:
+                self.ready_event.set()
+        self._logger.info("GPIO %s%s" % (readiness, "" if error is None else ": %s" % error))
+        self._plugin_manager.send_plugin_message(self._identifier,
+                                                 dict(type="readiness", readiness=readiness, error=error))
+
+    # True once GPIO is set up, waits up to timeout seconds for a setup still running
+    def wait_until_ready(self, timeout=None):
+        self.ready_event.wait(timeout)
+        return self.readiness == "ready"
+
+    def apply_settings(self):
+        self.reconfigure_gpio(self.setting_gpio_mode, self.load_sensors())
+        self.setup_jam_detection()
+
+    def on_shutdown(self):
+        self.stop_pin_check()
+        self.stop_sampler()
+        self.status.stop()
+        self.history.close()
 
     def on_settings_save(self, data):
         # Retrieve any settings not changed in order to validate that the combination of new and old settings end up in a bad combination
         self._logger.info("Saving settings for Filament Sensor Simplified")
         pin_to_save = self._settings.get_int(["pin"])
         gpio_mode_to_save = self._settings.get_int(["gpio_mode"])
-        power_to_save = self._settings.get_int(["power"])
-        trigger_mode_to_save = self._settings.get_int(["triggered"])
+        extra_sensors_to_save = self.setting_extra_sensors
 
         if "pin" in data:
             pin_to_save = int(data.get("pin"))
@@ -268,115 +1127,190 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
         if "gpio_mode" in data:
             gpio_mode_to_save = int(data.get("gpio_mode"))
 
-        if "power" in data:
-            power_to_save = int(data.get("power"))
+        if "extra_sensors" in data:
+            extra_sensors_to_save = data.get("extra_sensors") or []
 
-        if "trigger" in data:
-            trigger_mode_to_save = int(data.get("triggered"))
+        jam_pin_to_save = int(data.get("jam_pin", self.setting_jam_pin))
 
-        if pin_to_save is not None:
+        pins_to_save = [pin_to_save] + [int(sensor.get("pin", 0)) for sensor in extra_sensors_to_save]
+        pins_to_save.append(jam_pin_to_save)
+        used_pins = set()
+        for pin in pins_to_save:
             # check if pin is not power/ground pin or out of range but allow the disabled value (0)
-            if pin_to_save is not 0:
-                try:
-                    # BOARD
-                    if gpio_mode_to_save is 10:
-                        # before saving check if pin not used by others
-                        usage = GPIO.gpio_function(pin_to_save)
-                        self._logger.debug("usage on pin %s is %s" % (pin_to_save, usage))
-                        if usage is not 1:
-                            self._logger.info(
-                                "You are trying to save pin %s which is already used by others" % (pin_to_save))
-                            self._plugin_manager.send_plugin_message(self._identifier,
-                                                                     dict(type="error", autoClose=True,
-                                                                          msg="Filament sensor settings not saved, you are trying to use a pin which is already used by others"))
-                            return
-                    # BCM
-                    elif gpio_mode_to_save is 11:
-                        if pin_to_save > 27:
-                            self._logger.info(
-                                "You are trying to save pin %s which is out of range" % (pin_to_save))
-                            self._plugin_manager.send_plugin_message(self._identifier,
-                                                                     dict(type="error", autoClose=True,
-                                                                          msg="Filament sensor settings not saved, you are trying to use a pin which is out of range"))
-                            return
-
-                except ValueError:
-                    self._logger.info(
-                        "You are trying to save pin %s which is ground/power pin or out of range" % (pin_to_save))
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="error", autoClose=True,
-                                                                                    msg="Filament sensor settings not saved, you are trying to use a pin which is ground/power pin or out of range"))
-                    return
-                self.init_gpio(gpio_mode_to_save, pin_to_save, power_to_save, trigger_mode_to_save, False)
-                self.init_icon(pin_to_save, power_to_save, trigger_mode_to_save)
+            if pin is None or pin == 0:
+                continue
+            if pin in used_pins:
+                self.reject_settings("You are trying to save pin %s for more than one sensor" % pin,
+                                     "Filament sensor settings not saved, every sensor needs its own pin")
+                return
+            used_pins.add(pin)
+            # a lookup, pins taken by others are found when the settings are applied
+            if not self.pin_index.valid(gpio_mode_to_save, pin):
+                self.reject_settings("You are trying to save pin %s which is ground/power pin or out of range" % pin,
+                                     "Filament sensor settings not saved, you are trying to use a pin which is ground/power pin or out of range")
+                return
+
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self.cache_settings()
+        with self.readiness_lock:
+            readiness = self.readiness
+            if readiness == "starting":
+                self.reconfigure_when_ready = True
+        if readiness == "starting":
+            self._logger.info("GPIO setup still running, settings are applied once it is done")
+        elif readiness == "failed":
+            # e.g. another GPIO backend was chosen, try again with the new settings
+            self._logger.info("GPIO setup failed before, setting it up again")
+            self.start_gpio_setup()
+        else:
+            self.apply_settings()
 
-    def sending_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
-        if self.changing_filament_initiated:
-            if self.changing_filament_command_sent and self.changing_filament_started:
-                # M113 - host keepalive message, ignore this message
-                if not re.search("^M113", cmd):
-                    self._logger.debug("filament change sequence ended")
-                    self.changing_filament_initiated = False
-                    self.changing_filament_command_sent = False
-                    self.changing_filament_started = False
-                    if not self.read_sensor_multiple(self.setting_pin, self.setting_power, self.setting_triggered):
-                        self._logger.debug("reading sensor after change")
-                        self.send_out_of_filament()
-            if cmd == self.setting_gcode:
-                self._logger.debug("about to send out of filament g-code")
-                self.changing_filament_command_sent = True
+    def reject_settings(self, log_msg, msg):
+        self._logger.info(log_msg)
+        self._plugin_manager.send_plugin_message(self._identifier, dict(type="error", autoClose=True, msg=msg))
 
-        # deliberate change
-        if re.search("^M600", cmd):
-            self._logger.info("deliberate M600 was initiated")
-            self.changing_filament_initiated = True
-            self.changing_filament_command_sent = True
+    # runs for every line sent to the printer, keep it cheap
+    def sending_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+        self.sent_lines += 1
+        if self.pending_injection is not None:
+            return self.inject_runout(comm_instance, cmd, cmd_type, gcode, tags)
+        if self.sent_lines & self.hook_sample_mask:
+            return self.process_sending_gcode(cmd, gcode)
+        start = monotonic()
+        result = self.process_sending_gcode(cmd, gcode)
+        self.metric_hooks.observe(monotonic() - start, "sending")
+        return result
+
+    # sends the pending runout action in place of the line that was about to go out, that line is put back at
+    # the front of the send queue. OctoPrint ignores multi-entry results in the sending phase, so the action can't
+    # simply go out together with the line.
+    def inject_runout(self, comm_instance, cmd, cmd_type, gcode, tags):
+        result = self.process_sending_gcode(cmd, gcode)
+        runout_gcode = self.claim_injection()
+        if runout_gcode is None:
+            return result
+        if not self.requeue_line(comm_instance, cmd, cmd_type, tags):
+            self._logger.info("Can't put a line back into the send queue, queueing %s" % runout_gcode)
+            self._printer.commands(runout_gcode)
+            return result
+        self.workflow.fire(workflow.COMMAND)
+        # the current line goes out after the action
+        self.report_runout_lines(self.sent_lines - 1)
+        return runout_gcode
+
+    # puts a line that already went through the sending hooks back at the front of OctoPrint's send queue, it is
+    # marked processed so the hooks don't see it twice
+    def requeue_line(self, comm_instance, cmd, cmd_type, tags):
+        send_queue = getattr(comm_instance, "_send_queue", None)
+        if send_queue is None or not hasattr(send_queue, "prepend"):
+            return False
+        try:
+            # command, line number, command type, sent callback, processed, tags
+            send_queue.prepend((cmd, None, cmd_type, None, True, tags))
+        except Exception:
+            self._logger.exception("Putting %s back into the send queue failed" % cmd)
+            return False
+        return True
+
+    def process_sending_gcode(self, cmd, gcode):
+        if self.extrusion is not None:
+            self.extrusion.feed(gcode, cmd)
+            self.check_jam()
+        state = self.workflow.state
+        if state is workflow.IDLE:
+            # no filament change in progress, only a deliberate change matters
+            if cmd.startswith("M600") and self.workflow.fire(workflow.COMMAND) is not None:
+                self._logger.info("deliberate M600 was initiated")
+                self.trace.record(tracing.HOOK, "sending", cmd)
+                self.history.record(history.DELIBERATE_M600)
+                self.update_polling()
+            return
 
+        # M113 - host keepalive message, ignore this message
+        if state in workflow.CHANGE_STARTED and not cmd.startswith("M113"):
+            if self.workflow.fire(workflow.CHANGE_ENDED) is not None:
+                self._logger.debug("filament change sequence ended")
+                self.trace.record(tracing.HOOK, "sending", "change ended")
+                paused_at, self.paused_at = self.paused_at, None
+                self.history.record(history.CHANGE_ENDED, -1 if paused_at is None else time() - paused_at)
+                self.reset_jam_detection()
+                # never read the sensor on the comm thread, the debounced read takes seconds
+                self.check_filament_after_change()
+
+        if cmd in self.cached_gcodes:
+            if self.workflow.fire(workflow.COMMAND) is not None:
+                self._logger.debug("about to send out of filament g-code")
+                self.trace.record(tracing.HOOK, "sending", cmd)
+                self.report_runout_lines(self.sent_lines - 1)
+        elif cmd.startswith("M600"):
+            # deliberate change
+            if self.workflow.fire(workflow.COMMAND) is not None:
+                self._logger.info("deliberate M600 was initiated")
+                self.trace.record(tracing.HOOK, "sending", cmd)
+                self.history.record(history.DELIBERATE_M600)
+
+    # re-checks the sensor on a worker thread once the filament change has finished and reports back
+    # by sending the runout action again if the filament still isn't there
+    def check_filament_after_change(self):
+        worker = threading.Thread(target=self._check_filament_after_change,
+                                  name="filamentsensorsimplified-recheck")
+        worker.daemon = True
+        worker.start()
+
+    def _check_filament_after_change(self):
+        self._logger.debug("reading sensor after change")
+        change_ended = time()
+        if self.sampler is not None:
+            self.sampler.poke()
+        if self.filament_present(newer_than=change_ended) is False:
+            if self.workflow.idle and self.printing:
+                self.send_out_of_filament(self.runout_sensor())
+
+    # runs for every line received from the printer, keep it cheap
     def gcode_response_received(self, comm, line, *args, **kwargs):
-        if self.changing_filament_command_sent:
-            if re.search("busy: paused for user", line):
-                self._logger.debug("received busy paused for user")
-                if not self.paused_for_user:
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="info", autoClose=False,
-                                                                                    msg="Filament change: printer is waiting for user input."))
-                    self.paused_for_user = True
-                    self.changing_filament_started = True
-            elif re.search("echo:busy: processing", line):
-                self._logger.debug("received busy processing")
-                if self.paused_for_user:
-                    self.paused_for_user = False
+        self.received_lines += 1
+        if self.received_lines & self.hook_sample_mask:
+            return self.process_response(line)
+        start = monotonic()
+        result = self.process_response(line)
+        self.metric_hooks.observe(monotonic() - start, "received")
+        return result
+
+    def process_response(self, line):
+        if self.workflow.state not in workflow.PRINTER_CHANGING:
+            return line
+        if "busy: paused for user" in line:
+            self._logger.debug("received busy paused for user")
+            if self.workflow.fire(workflow.PAUSED) is not None:
+                self.trace.record(tracing.HOOK, "received", "paused for user")
+                self.paused_at = time()
+                self.history.record(history.PAUSED_FOR_USER)
+                self._plugin_manager.send_plugin_message(self._identifier, dict(type="info", autoClose=False,
+                                                                                msg="Filament change: printer is waiting for user input."))
+        elif "echo:busy: processing" in line:
+            self._logger.debug("received busy processing")
+            if self.workflow.fire(workflow.PROCESSING) is not None:
+                self.trace.record(tracing.HOOK, "received", "processing")
         return line
 
-    def init_icon(self, pin, power, triggered):
-        if not self.gpio_initialized:
-            return
-        self._logger.info("Setting icon status")
-        iconPresent = self.is_filament_present(pin, power, triggered)
-        self._plugin_manager.send_plugin_message(self._identifier,
-                                                 dict(type="filamentStatus", noFilament=iconPresent,
-                                                      msg="Initial filament read"))
-
-    def read_sensor_multiple(self, pin, power, trigger_mode):
-        self._logger.info("Reading sensor values")
-        oldTrigger = None
-        x = 0
+    def read_sensor_multiple(self, pin, power, trigger_mode, progress=None):
+        start = monotonic()
+        debounce = self.debounce_factory()
+        debounce.reset(now=time())
+        reads = 0
 
-        # take a reading of 10 consecutive reads to prevent false positives
+        # keep reading until the debounce filter settles to prevent false positives
         while True:
-            newTrigger = self.read_sensor(pin, power, trigger_mode)
-            x += 1
-
-            if oldTrigger is None:
-                oldTrigger = newTrigger
-            elif oldTrigger != newTrigger:
-                x = 0
-                self._logger.info("Repeating sensor read due to false positives")
-
-            if x < 10:
-                sleep(0.2)
-            else:
-                self._logger.info("Reading result: %s" % newTrigger)
-                return newTrigger
+            result = debounce.update(self.read_sensor(pin, power, trigger_mode), time())
+            reads += 1
+            if progress is not None and reads % self.test_progress_reads == 0:
+                progress(reads, debounce.flips)
+            if result is not None:
+                self.trace.record(tracing.ONE_SHOT, "pin %s" % pin, (result, debounce.flips))
+                self.metric_read_multiple.observe(monotonic() - start)
+                self.metric_read_multiple_flips.inc(debounce.flips, pin)
+                return result
+            sleep(self.debounce_interval)
 
     # plugin disabled if pin set to 0
     def plugin_enabled(self, pin):
@@ -384,50 +1318,55 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
 
     # read sensor input value
     def read_sensor(self, pin, power, trigger_mode):
-        self._logger.debug("reading pin %s " % pin)
-        self.pull_resistor(pin, power)
-        pin_value = GPIO.input(pin)
-        return (pin_value + power + trigger_mode) % 2 is 0
+        self.ensure_input(pin, power)
+        try:
+            pin_value = self.gpio.input(pin)
+        except RuntimeError:
+            # pin has been released behind our back (e.g. GPIO.cleanup by another plugin), set it up again
+            self.pin_setup.pop(pin, None)
+            self.ensure_input(pin, power)
+            pin_value = self.gpio.input(pin)
+        return (pin_value + power + trigger_mode) % 2 == 0
 
     def on_event(self, event, payload):
         # if user has logged in show appropriate popup
         if event is Events.CLIENT_OPENED:
-            # if plugin enabled init icon on client open
-            if self.plugin_enabled(self.setting_pin):
-                self.init_icon(self.setting_pin, self.setting_power, self.setting_triggered)
-            if self.changing_filament_initiated and not self.changing_filament_command_sent:
-                self.show_printer_runout_popup()
-            elif self.changing_filament_command_sent and not self.paused_for_user:
+            # the icon is set from the status snapshot the client fetches on its own
+            state = self.workflow.state
+            if state is workflow.RUNOUT_PENDING or state is workflow.COMMAND_SENT or state is workflow.RESUMING:
                 self.show_printer_runout_popup()
             # printer is waiting for user to put in new filament
-            elif self.changing_filament_command_sent and self.paused_for_user:
+            elif state is workflow.PAUSED_FOR_USER:
                 self._plugin_manager.send_plugin_message(self._identifier, dict(type="info", autoClose=False,
                                                                                 msg="Printer ran out of filament! It's waiting for user input"))
             # if the plugin hasn't been initialized
-            if not self.plugin_enabled(self.setting_pin):
+            if not any(self.plugin_enabled(sensor.pin) for sensor in self.load_sensors()):
                 self._plugin_manager.send_plugin_message(self._identifier, dict(type="info", autoClose=True,
                                                                                 msg="Don't forget to configure this plugin."))
 
         elif event in (Events.PRINT_STARTED, Events.PRINT_RESUMED):
-            self.changing_filament_initiated = False
-            self.changing_filament_command_sent = False
-            self.paused_for_user = False
+            self.workflow.fire(workflow.RESET)
+            self.paused_at = None
             self.printing = True
+            if event is Events.PRINT_STARTED:
+                self.history.start_job((payload or {}).get("name"))
+            self.reset_jam_detection()
+            self.update_polling()
 
             # print started with no filament present
-            if event is Events.PRINT_STARTED and self.plugin_enabled(self.setting_pin):
+            if event is Events.PRINT_STARTED and self.sensors:
                 self._logger.info("Starting print.")
-                if not self.read_sensor_multiple(self.setting_pin, self.setting_power, self.setting_triggered):
+                if self.filament_present() is False:
                     self._logger.info("Printing aborted: no filament detected!")
                     self._printer.cancel_print()
                     self._plugin_manager.send_plugin_message(self._identifier, dict(type="error", autoClose=True,
                                                                                     msg="No filament detected! Print cancelled."))
             # print resumed with no filament present
-            elif event is Events.PRINT_RESUMED and self.plugin_enabled(self.setting_pin):
+            elif event is Events.PRINT_RESUMED and self.sensors:
                 self._logger.info("Resuming print.")
-                if not self.read_sensor_multiple(self.setting_pin, self.setting_power, self.setting_triggered):
+                if self.filament_present() is False:
                     self._logger.info("Resuming print aborted: no filament detected!")
-                    self.send_out_of_filament()
+                    self.send_out_of_filament(self.runout_sensor())
                     self._plugin_manager.send_plugin_message(self._identifier, dict(type="error", autoClose=True,
                                                                                     msg="Resuming print aborted: no filament detected!"))
 
@@ -435,10 +1374,21 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
                 Events.PRINT_FAILED,
                 Events.PRINT_CANCELLED,
                 Events.ERROR):
-            self.changing_filament_initiated = False
-            self.changing_filament_command_sent = False
-            self.paused_for_user = False
+            # a runout action still waiting for the next line is moot now
+            self.claim_injection()
+            self.runout_edge_line = None
+            self.workflow.fire(workflow.RESET)
+            self.paused_at = None
             self.printing = False
+            self.history.end_job(self.job_results[event])
+
+    # how a print ended as kept in the history
+    job_results = {
+        Events.PRINT_DONE: "done",
+        Events.PRINT_FAILED: "failed",
+        Events.PRINT_CANCELLED: "cancelled",
+        Events.ERROR: "error"
+    }
 
     def get_update_information(self):
         # Define the configuration for your plugin to use with the Software Update
@@ -472,16 +1422,6 @@ __plugin_name__ = "Filament Sensor Simplified"
 __plugin_version__ = "0.3.1"
 
 
-def __plugin_check__():
-    try:
-        import RPi.GPIO as GPIO
-        if GPIO.VERSION < "0.6":  # Need at least 0.6 for edge detection
-            return False
-    except ImportError:
-        return False
-    return True
-
-
 def __plugin_load__():
     global __plugin_implementation__
     __plugin_implementation__ = Filament_sensor_simplifiedPlugin()
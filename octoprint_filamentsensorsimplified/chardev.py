@@ -0,0 +1,369 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import errno
+import os
+import select
+import threading
+from datetime import timedelta
+
+from . import gpio_backend, pins
+from .gpio_backend import monotonic
+
+
+class GpiodBackend(gpio_backend.GPIOBackend):
+    # Linux GPIO character device through libgpiod (python bindings 2.x), works on newer Pis and other boards
+    # where RPi.GPIO is deprecated. Debouncing is done by the kernel and edge events carry kernel timestamps,
+    # they are read in batches by a single thread and handed to the callback one by one.
+    #
+    # Lines are addressed by their offset on the chip, which on a Raspberry Pi is the BCM number, BOARD pins
+    # are translated.
+
+    name = "gpiod"
+
+    consumer = "filamentsensorsimplified"
+
+    # most edge events read at once
+    event_batch = 16
+
+    def __init__(self, gpiod=None, chip="/dev/gpiochip0", debounce=10):
+        if gpiod is None:
+            import gpiod
+        self._gpiod = gpiod
+        self._chip_path = chip
+        # longest kernel debounce period in ms, 0 disables it
+        self._debounce = debounce
+        self.chip = gpiod.Chip(chip)
+        self._mode = None
+        self._lock = threading.RLock()
+        self._requests = {}
+        self._pulls = {}
+        self._edges = {}
+        self._debounces = {}
+        self._callbacks = {}
+        self._thread = None
+        self._wake_read, self._wake_write = os.pipe()
+
+    def getmode(self):
+        return self._mode
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    def cleanup(self):
+        with self._lock:
+            self._callbacks.clear()
+            for request in self._requests.values():
+                request.release()
+            self._requests.clear()
+            self._pulls.clear()
+            self._edges.clear()
+            self._debounces.clear()
+            self._mode = None
+        self._wake()
+
+    def release(self, pin):
+        offset = self.offset(pin)
+        with self._lock:
+            self._callbacks.pop(offset, None)
+            request = self._requests.pop(offset, None)
+            if request is not None:
+                request.release()
+            self._pulls.pop(offset, None)
+            self._edges.pop(offset, None)
+            self._debounces.pop(offset, None)
+        self._wake()
+
+    def offset(self, pin):
+        if self._mode is None:
+            raise RuntimeError("Please set pin numbering mode first")
+        info = pins.pin_index(self.board_revision()).lookup(self._mode, pin)
+        if info is None:
+            raise ValueError("The channel sent is invalid on a Raspberry Pi")
+        return info.bcm
+
+    def gpio_function(self, pin):
+        offset = self.offset(pin)
+        if offset in self._requests:
+            return gpio_backend.IN
+        info = self.chip.get_line_info(offset)
+        if info.used:
+            # somebody else holds the line
+            return gpio_backend.OUT if info.direction == self._gpiod.line.Direction.OUTPUT else gpio_backend.UNKNOWN
+        return gpio_backend.IN
+
+    # requests the line or changes its configuration, the line is never released in between
+    def _configure(self, offset, pull_up_down, edge, debounce=0):
+        line = self._gpiod.line
+        settings = dict(direction=line.Direction.INPUT,
+                        bias=line.Bias.PULL_UP if pull_up_down == gpio_backend.PUD_UP else line.Bias.PULL_DOWN)
+        if edge is not None:
+            settings["edge_detection"] = {gpio_backend.RISING: line.Edge.RISING,
+                                          gpio_backend.FALLING: line.Edge.FALLING,
+                                          gpio_backend.BOTH: line.Edge.BOTH}[edge]
+            if debounce:
+                settings["debounce_period"] = timedelta(milliseconds=debounce)
+        config = {offset: self._gpiod.LineSettings(**settings)}
+        with self._lock:
+            request = self._requests.get(offset)
+            if request is None:
+                self._requests[offset] = self.chip.request_lines(consumer=self.consumer, config=config)
+            else:
+                request.reconfigure_lines(config=config)
+            self._pulls[offset] = pull_up_down
+            self._edges[offset] = edge
+            self._debounces[offset] = debounce
+
+    def setup_input(self, pin, pull_up_down):
+        offset = self.offset(pin)
+        # keep edge detection when only the pull resistor changes
+        self._configure(offset, pull_up_down, self._edges.get(offset), self._debounces.get(offset, 0))
+
+    def input(self, pin):
+        offset = self.offset(pin)
+        request = self._requests.get(offset)
+        if request is None:
+            raise RuntimeError("You must setup() the GPIO channel first")
+        return 1 if request.get_value(offset) == self._gpiod.line.Value.ACTIVE else 0
+
+    def add_event_detect(self, pin, edge, callback, bouncetime):
+        # the kernel debounces the line for bouncetime ms but never longer than the configured period, a fast line
+        # like the jam encoder keeps its own short period and the slow sensors are left to the software filter
+        offset = self.offset(pin)
+        debounce = min(self._debounce, bouncetime or 0)
+        with self._lock:
+            if offset in self._callbacks:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            if offset not in self._pulls:
+                raise RuntimeError("You must setup() the GPIO channel first")
+            self._configure(offset, self._pulls[offset], edge, debounce)
+            self._callbacks[offset] = (pin, callback)
+        self._start_events()
+
+    def remove_event_detect(self, pin):
+        offset = self.offset(pin)
+        with self._lock:
+            if self._callbacks.pop(offset, None) is None:
+                return
+            self._configure(offset, self._pulls[offset], None)
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, b"x")
+        except OSError:
+            pass
+
+    def _start_events(self):
+        if self._thread is not None:
+            self._wake()
+            return
+        self._thread = threading.Thread(target=self._read_events, name="filamentsensorsimplified-gpiod")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_events(self):
+        while True:
+            with self._lock:
+                requests = [(request.fd, offset, request) for offset, request in self._requests.items()
+                            if offset in self._callbacks]
+            fds = [fd for fd, _, _ in requests] + [self._wake_read]
+            try:
+                readable, _, _ = select.select(fds, [], [])
+            except (OSError, ValueError, select.error):
+                # interrupted or a request got released while waiting, collect the file descriptors again
+                continue
+            if self._wake_read in readable:
+                os.read(self._wake_read, 64)
+            for fd, offset, request in requests:
+                if fd not in readable:
+                    continue
+                try:
+                    events = request.read_edge_events(self.event_batch)
+                except (OSError, ValueError):
+                    # request released while waiting
+                    continue
+                if not events:
+                    continue
+                callback = self._callbacks.get(offset)
+                if callback is None:
+                    continue
+                pin, function = callback
+                # one callback per edge like RPi.GPIO, the encoder counts every pulse
+                for event in events:
+                    function(pin, event.timestamp_ns / 1e9)
+
+
+# stand-in for the gpiod module talking to a simulated chip instead of /dev/gpiochip*, lines follow their
+# bias unless driven by MockChip.set_level(), kernel debouncing and event timestamps are emulated
+
+class _Enum(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+class _Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+_line = _Namespace(
+    Direction=_Namespace(AS_IS=_Enum("AS_IS"), INPUT=_Enum("INPUT"), OUTPUT=_Enum("OUTPUT")),
+    Bias=_Namespace(AS_IS=_Enum("AS_IS"), DISABLED=_Enum("DISABLED"), PULL_UP=_Enum("PULL_UP"),
+                    PULL_DOWN=_Enum("PULL_DOWN")),
+    Edge=_Namespace(NONE=_Enum("NONE"), RISING=_Enum("RISING"), FALLING=_Enum("FALLING"), BOTH=_Enum("BOTH")),
+    Value=_Namespace(INACTIVE=_Enum("INACTIVE"), ACTIVE=_Enum("ACTIVE"))
+)
+
+
+class MockLineSettings(object):
+    def __init__(self, direction=None, bias=None, edge_detection=None, debounce_period=None, **kwargs):
+        self.direction = direction
+        self.bias = bias
+        self.edge_detection = edge_detection
+        self.debounce_period = debounce_period
+
+
+class MockEdgeEvent(object):
+    Type = _Namespace(RISING_EDGE=_Enum("RISING_EDGE"), FALLING_EDGE=_Enum("FALLING_EDGE"))
+
+    def __init__(self, event_type, timestamp_ns, line_offset):
+        self.event_type = event_type
+        self.timestamp_ns = timestamp_ns
+        self.line_offset = line_offset
+
+
+class MockLineRequest(object):
+    def __init__(self, chip, offset, settings):
+        self._chip = chip
+        self.offset = offset
+        self.settings = settings
+        self._events = []
+        self._lock = threading.Lock()
+        self.fd, self._notify = os.pipe()
+        self.released = False
+
+    def get_value(self, offset):
+        return _line.Value.ACTIVE if self._chip.level(offset) else _line.Value.INACTIVE
+
+    def reconfigure_lines(self, config):
+        self.settings = config[self.offset]
+
+    def read_edge_events(self, max_events=None):
+        with self._lock:
+            count = len(self._events) if max_events is None else min(max_events, len(self._events))
+            events, self._events = self._events[:count], self._events[count:]
+        if events:
+            os.read(self.fd, len(events))
+        return events
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self._chip.release(self.offset)
+        os.close(self._notify)
+        os.close(self.fd)
+
+    def push(self, event):
+        if self.released:
+            return
+        with self._lock:
+            self._events.append(event)
+        os.write(self._notify, b"e")
+
+
+class MockChip(object):
+    # chips shared by path, like the real device files
+    chips = {}
+
+    def __new__(cls, path):
+        chip = cls.chips.get(path)
+        if chip is None:
+            chip = object.__new__(cls)
+            chip._init(path)
+            cls.chips[path] = chip
+        return chip
+
+    def _init(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._requests = {}
+        self._driven = {}
+        # last level reported through an edge event, used by the emulated debounce
+        self._reported = {}
+        # lines held by other consumers: offset -> direction
+        self.foreign = {}
+
+    def get_line_info(self, offset):
+        request = self._requests.get(offset)
+        if request is not None:
+            return _Namespace(offset=offset, used=True, consumer=GpiodBackend.consumer,
+                              direction=request.settings.direction)
+        if offset in self.foreign:
+            return _Namespace(offset=offset, used=True, consumer="other", direction=self.foreign[offset])
+        return _Namespace(offset=offset, used=False, consumer=None, direction=_line.Direction.INPUT)
+
+    def request_lines(self, consumer, config):
+        with self._lock:
+            (offset, settings), = config.items()
+            if offset in self._requests or offset in self.foreign:
+                raise OSError(errno.EBUSY, "Device or resource busy")
+            request = MockLineRequest(self, offset, settings)
+            self._requests[offset] = request
+            self._reported[offset] = self.level(offset)
+            return request
+
+    def release(self, offset):
+        with self._lock:
+            self._requests.pop(offset, None)
+
+    def level(self, offset):
+        driven = self._driven.get(offset)
+        if driven is not None:
+            return driven
+        request = self._requests.get(offset)
+        return 1 if request is not None and request.settings.bias == _line.Bias.PULL_UP else 0
+
+    # drives the line from outside, None releases it back to its bias
+    def set_level(self, offset, level):
+        with self._lock:
+            self._driven[offset] = level
+            request = self._requests.get(offset)
+        if request is None:
+            return
+        debounce = request.settings.debounce_period
+        if debounce:
+            # kernel reports the edge only once the line has been stable for the debounce period
+            timer = threading.Timer(debounce.total_seconds(), self._settle, args=(offset, monotonic()))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._settle(offset, monotonic())
+
+    def _settle(self, offset, timestamp):
+        with self._lock:
+            request = self._requests.get(offset)
+            if request is None:
+                return
+            level = self.level(offset)
+            if level == self._reported.get(offset):
+                return
+            self._reported[offset] = level
+        edge = request.settings.edge_detection
+        if edge is None or edge == _line.Edge.NONE:
+            return
+        if edge == _line.Edge.BOTH or (edge == _line.Edge.RISING and level) or (edge == _line.Edge.FALLING and not level):
+            event_type = MockEdgeEvent.Type.RISING_EDGE if level else MockEdgeEvent.Type.FALLING_EDGE
+            request.push(MockEdgeEvent(event_type, int(timestamp * 1e9), offset))
+
+
+mock_gpiod = _Namespace(
+    Chip=MockChip,
+    LineSettings=MockLineSettings,
+    EdgeEvent=MockEdgeEvent,
+    line=_line
+)
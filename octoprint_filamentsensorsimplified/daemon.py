@@ -0,0 +1,570 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Sensor daemon for several OctoPrint instances on one host. A single process owns GPIO, sets the pins up, watches
+# them and pushes every level change to the instances subscribed to the pin, the instances use DaemonBackend
+# instead of touching GPIO themselves. Run it with
+#
+#     python -m octoprint_filamentsensorsimplified.daemon --socket /run/filamentsensorsimplified/daemon.sock
+#
+# Only the daemon's user and group may connect, the socket directory is created for the daemon's user if missing.
+#
+# The protocol is one JSON object per line over a Unix stream socket. Requests carry an id that the response
+# repeats ({"id": 1, "result": ...} or {"id": 1, "error": "...", "type": "ValueError"}), level changes are pushed
+# as {"event": "level", "pin": 7, "level": 0, "time": 1234.5}. Pins are numbered in the daemon's mode, times are
+# on the monotonic clock which is shared by all processes on the host.
+
+import argparse
+import errno
+import grp
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    # python 2
+    import SocketServer as socketserver
+
+from . import gpio_backend, pins
+from .gpio_backend import DEFAULT_SOCKET, monotonic
+
+
+def encode(message):
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+def decode(line):
+    return json.loads(line.decode("utf-8"))
+
+
+class _Subscriber(object):
+    # connection of one OctoPrint instance, pushes and responses are written from several threads
+
+    def __init__(self, connection, wfile):
+        self.connection = connection
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self.pins = set()
+        self.alive = True
+
+    def send(self, message):
+        data = encode(message)
+        with self._lock:
+            if not self.alive:
+                return
+            try:
+                self._wfile.write(data)
+                self._wfile.flush()
+            except (IOError, OSError, socket.error):
+                self.alive = False
+
+    def close(self):
+        self.alive = False
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        daemon = self.server.sensor_daemon
+        subscriber = _Subscriber(self.request, self.wfile)
+        daemon.connected(subscriber)
+        try:
+            while subscriber.alive:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                try:
+                    request = decode(line)
+                except ValueError:
+                    daemon.logger.warn("Dropping malformed request %r" % line)
+                    continue
+                subscriber.send(daemon.handle(subscriber, request))
+        finally:
+            daemon.drop(subscriber)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class SensorDaemon(object):
+    # owns the GPIO backend, pins are set up as inputs for the first instance asking and released when the last
+    # one lets go. Levels are watched through edge detection, polling every poll_interval catches what it missed.
+
+    def __init__(self, backend, mode, socket_path=DEFAULT_SOCKET, poll_interval=0.02, bounce_time=1, logger=None,
+                 socket_mode=0o660, group=None):
+        self.backend = backend
+        # pin numbering used on the socket, BOARD or BCM
+        self.mode = mode
+        self.socket_path = socket_path
+        # permissions of the socket, and the group allowed to connect (None keeps the daemon's group)
+        self.socket_mode = socket_mode
+        self.group = group
+        self.poll_interval = poll_interval
+        # bounce time of the edge detection in ms, the instances debounce on their own
+        self.bounce_time = bounce_time
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.RLock()
+        # pull resistor and subscribers of every pin in use
+        self._pulls = {}
+        self._subscribers = {}
+        self._levels = {}
+        self._connections = set()
+        self._server = None
+        self._wake = threading.Event()
+        self._running = False
+        self._handlers = dict(
+            hello=self._hello,
+            function=self._function,
+            setup=self._setup,
+            input=self._input,
+            release=self._release
+        )
+
+    def start(self):
+        if self.backend.getmode() is None:
+            self.backend.setmode(self.mode)
+        elif self.backend.getmode() != self.mode:
+            raise RuntimeError("GPIO mode is already set to %s" % self.backend.getmode())
+        gid = -1 if self.group is None else grp.getgrnam(self.group).gr_gid
+        self._prepare_directory(gid)
+        self._remove_stale_socket()
+        # nobody else can connect between bind and chmod
+        umask = os.umask(0o177)
+        try:
+            self._server = _Server(self.socket_path, _Handler)
+        finally:
+            os.umask(umask)
+        os.chown(self.socket_path, -1, gid)
+        os.chmod(self.socket_path, self.socket_mode)
+        self._server.sensor_daemon = self
+        self._running = True
+        for target, name in ((self._server.serve_forever, "filamentsensorsimplified-daemon"),
+                             (self._poll, "filamentsensorsimplified-daemon-poll")):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+        self.logger.info("Sensor daemon listening on %s" % self.socket_path)
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        with self._lock:
+            connections = list(self._connections)
+            for pin in list(self._pulls):
+                self._forget(pin)
+        # the instances notice and reconnect to the next daemon
+        for subscriber in connections:
+            subscriber.close()
+
+    # the socket directory is created for the daemon's user and group, one anybody may write to is refused
+    def _prepare_directory(self, gid):
+        directory = os.path.dirname(os.path.abspath(self.socket_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            os.chown(directory, -1, gid)
+            os.chmod(directory, 0o750)
+        elif os.stat(directory).st_mode & 0o002:
+            raise RuntimeError("%s can be written by every user, put the socket in a directory owned by the daemon"
+                               % directory)
+
+    # a socket file left behind by a daemon that died is removed, one still answering is an error
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except socket.error as e:
+            if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            os.unlink(self.socket_path)
+        else:
+            raise RuntimeError("Another sensor daemon is listening on %s" % self.socket_path)
+        finally:
+            probe.close()
+
+    def handle(self, subscriber, request):
+        response = dict(id=request.get("id"))
+        handler = self._handlers.get(request.get("op"))
+        try:
+            if handler is None:
+                raise ValueError("Unknown request %s" % request.get("op"))
+            response["result"] = handler(subscriber, request)
+        except (RuntimeError, ValueError) as e:
+            response["error"] = str(e)
+            response["type"] = type(e).__name__
+        return response
+
+    def connected(self, subscriber):
+        with self._lock:
+            self._connections.add(subscriber)
+
+    # the instance disconnected, its pins are released
+    def drop(self, subscriber):
+        subscriber.alive = False
+        with self._lock:
+            self._connections.discard(subscriber)
+            for pin in list(subscriber.pins):
+                self._unsubscribe(subscriber, pin)
+
+    def _hello(self, subscriber, request):
+        return dict(mode=self.mode, revision=self.backend.board_revision())
+
+    def _function(self, subscriber, request):
+        return self.backend.gpio_function(request["pin"])
+
+    # subscribes to the pin and returns its level, the pin is set up if nobody uses it yet
+    def _setup(self, subscriber, request):
+        pin = request["pin"]
+        pull = request["pull"]
+        with self._lock:
+            current = self._pulls.get(pin)
+            others = self._subscribers.get(pin, set()) - set((subscriber,))
+            if current is not None and current != pull and others:
+                raise RuntimeError("Pin %s is used by another instance with the other pull resistor" % pin)
+            if current != pull:
+                self.backend.setup_input(pin, pull)
+                self._pulls[pin] = pull
+            if pin not in self._subscribers:
+                self._subscribers[pin] = set()
+                try:
+                    self.backend.add_event_detect(pin, gpio_backend.BOTH, self._edge, self.bounce_time)
+                except RuntimeError as e:
+                    self.logger.warn("Pin %s: no edge detection, polling only: %s" % (pin, e))
+            self._subscribers[pin].add(subscriber)
+            subscriber.pins.add(pin)
+            level = self._levels[pin] = self.backend.input(pin)
+        self.logger.info("Pin %s set up for %d instance(s)" % (pin, len(self._subscribers[pin])))
+        return level
+
+    def _input(self, subscriber, request):
+        pin = request["pin"]
+        with self._lock:
+            if pin not in self._pulls:
+                raise RuntimeError("Pin %s has not been set up" % pin)
+            return self.backend.input(pin)
+
+    def _release(self, subscriber, request):
+        with self._lock:
+            self._unsubscribe(subscriber, request["pin"])
+
+    def _unsubscribe(self, subscriber, pin):
+        subscriber.pins.discard(pin)
+        subscribers = self._subscribers.get(pin)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            self._forget(pin)
+
+    # nobody is subscribed anymore, the pin is given back
+    def _forget(self, pin):
+        self._subscribers.pop(pin, None)
+        self._pulls.pop(pin, None)
+        self._levels.pop(pin, None)
+        try:
+            self.backend.release(pin)
+        except (RuntimeError, ValueError):
+            pass
+
+    def _edge(self, pin, timestamp=None):
+        self._refresh(pin, monotonic() if timestamp is None else timestamp)
+
+    # reads the pin and pushes the level if it changed
+    def _refresh(self, pin, timestamp):
+        with self._lock:
+            pull = self._pulls.get(pin)
+            if pull is None:
+                return
+            try:
+                level = self.backend.input(pin)
+            except RuntimeError as e:
+                # released behind our back, set it up again
+                self.logger.warn("Pin %s: %s, setting it up again" % (pin, e))
+                self.backend.setup_input(pin, pull)
+                level = self.backend.input(pin)
+            if level == self._levels.get(pin):
+                return
+            self._levels[pin] = level
+            subscribers = list(self._subscribers.get(pin, ()))
+        message = dict(event="level", pin=pin, level=level, time=timestamp)
+        for subscriber in subscribers:
+            subscriber.send(message)
+
+    def _poll(self):
+        while self._running:
+            for pin in list(self._pulls):
+                try:
+                    self._refresh(pin, monotonic())
+                except (RuntimeError, ValueError) as e:
+                    self.logger.warn("Pin %s: reading failed: %s" % (pin, e))
+            self._wake.wait(self.poll_interval)
+
+
+class DaemonBackend(gpio_backend.GPIOBackend):
+    # GPIO through the sensor daemon. Pin mode and setup are private to this instance, pins are translated to the
+    # daemon's numbering. Levels are pushed by the daemon and cached, input() doesn't leave the process once a
+    # pin is set up. A lost connection is reestablished by the next request.
+
+    name = "daemon"
+
+    # delay between attempts to reconnect to a daemon that went away, in seconds
+    reconnect_interval = 1.0
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=5.0):
+        self.socket_path = socket_path
+        # seconds to wait for an answer of the daemon
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        self._socket = None
+        self._ids = 0
+        self._pending = {}
+        self._mode = None
+        self._daemon_mode = None
+        self._revision = 3
+        # pull resistor by pin in our numbering
+        self._pulls = {}
+        # pushed levels by pin in the daemon's numbering
+        self._levels = {}
+        self._detections = {}
+        self._last_callback = {}
+        self._connect()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error as e:
+            sock.close()
+            raise RuntimeError("Connecting to the sensor daemon at %s failed: %s" % (self.socket_path, e))
+        self._socket = sock
+        self._levels.clear()
+        reader = threading.Thread(target=self._read, args=(sock,), name="filamentsensorsimplified-daemon-client")
+        reader.daemon = True
+        reader.start()
+        hello = self._request("hello")
+        self._daemon_mode = hello["mode"]
+        self._revision = hello.get("revision", 3)
+        # a daemon started again doesn't know our pins
+        for pin, pull in list(self._pulls.items()):
+            self._subscribe(self._daemon_pin(pin), pull)
+
+    def _read(self, sock):
+        stream = sock.makefile("rb")
+        try:
+            for line in stream:
+                message = decode(line)
+                if message.get("event") == "level":
+                    self._level_changed(message)
+                    continue
+                slot = self._pending.pop(message.get("id"), None)
+                if slot is not None:
+                    slot[1] = message
+                    slot[0].set()
+        except (IOError, OSError, socket.error, ValueError):
+            pass
+        finally:
+            stream.close()
+            if self._socket is sock:
+                self._socket = None
+            sock.close()
+            # nobody answers the requests in flight anymore and the cached levels aren't updated
+            for slot in list(self._pending.values()):
+                slot[0].set()
+            self._levels.clear()
+        self._reconnect()
+
+    # pins with edge detection only are never read, keep trying so their edges come through again
+    def _reconnect(self):
+        while self._pulls and self._socket is None:
+            time.sleep(self.reconnect_interval)
+            with self._lock:
+                if self._socket is not None or not self._pulls:
+                    return
+                try:
+                    self._connect()
+                except RuntimeError as e:
+                    logging.getLogger(__name__).debug(str(e))
+
+    def _request(self, op, **arguments):
+        with self._lock:
+            if self._socket is None:
+                self._connect()
+            self._ids += 1
+            request_id = self._ids
+            slot = self._pending[request_id] = [threading.Event(), None]
+            try:
+                self._socket.sendall(encode(dict(arguments, id=request_id, op=op)))
+            except socket.error as e:
+                self._pending.pop(request_id, None)
+                raise RuntimeError("Sensor daemon connection lost: %s" % e)
+        if not slot[0].wait(self.timeout):
+            self._pending.pop(request_id, None)
+            raise RuntimeError("Sensor daemon didn't answer %s within %s s" % (op, self.timeout))
+        response = slot[1]
+        if response is None:
+            raise RuntimeError("Sensor daemon connection lost")
+        if "error" in response:
+            raise (ValueError if response.get("type") == "ValueError" else RuntimeError)(response["error"])
+        return response.get("result")
+
+    # pin in the daemon's numbering, raises like RPi.GPIO for an unset mode and pins without a counterpart
+    def _daemon_pin(self, pin):
+        if self._mode is None:
+            raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+        daemon_pin = pins.pin_index(self._revision).convert(pin, self._mode, self._daemon_mode)
+        if daemon_pin is None:
+            raise ValueError("The channel sent is invalid on a Raspberry Pi")
+        return daemon_pin
+
+    def board_revision(self):
+        return self._revision
+
+    def getmode(self):
+        return self._mode
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    # releases our pins only, other instances keep theirs
+    def cleanup(self):
+        with self._lock:
+            pins = [self._daemon_pin(pin) for pin in self._pulls] if self._mode is not None else []
+            self._pulls.clear()
+            self._detections.clear()
+            self._mode = None
+        for pin in pins:
+            self._levels.pop(pin, None)
+            try:
+                self._request("release", pin=pin)
+            except RuntimeError:
+                pass
+
+    def release(self, pin):
+        daemon_pin = self._daemon_pin(pin)
+        with self._lock:
+            self._pulls.pop(pin, None)
+            self._detections.pop(pin, None)
+        self._levels.pop(daemon_pin, None)
+        self._request("release", pin=daemon_pin)
+
+    def gpio_function(self, pin):
+        return self._request("function", pin=self._daemon_pin(pin))
+
+    def setup_input(self, pin, pull_up_down):
+        daemon_pin = self._daemon_pin(pin)
+        self._pulls[pin] = pull_up_down
+        self._subscribe(daemon_pin, pull_up_down)
+
+    def _subscribe(self, daemon_pin, pull_up_down):
+        self._levels.pop(daemon_pin, None)
+        level = self._request("setup", pin=daemon_pin, pull=pull_up_down)
+        # a level pushed while the request was answered is newer
+        return self._levels.setdefault(daemon_pin, level)
+
+    def input(self, pin):
+        daemon_pin = self._daemon_pin(pin)
+        level = self._levels.get(daemon_pin)
+        if level is not None:
+            return level
+        pull = self._pulls.get(pin)
+        if pull is None:
+            raise RuntimeError("You must setup() the GPIO channel first")
+        # first read after a reconnect
+        return self._subscribe(daemon_pin, pull)
+
+    def add_event_detect(self, pin, edge, callback, bouncetime):
+        self._daemon_pin(pin)
+        with self._lock:
+            if pin in self._detections:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self._detections[pin] = (edge, callback, bouncetime)
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._detections.pop(pin, None)
+
+    def _level_changed(self, message):
+        daemon_pin = message["pin"]
+        level = message["level"]
+        old = self._levels.get(daemon_pin)
+        self._levels[daemon_pin] = level
+        if old is None or old == level or self._mode is None:
+            return
+        pin = pins.pin_index(self._revision).convert(daemon_pin, self._daemon_mode, self._mode)
+        detection = self._detections.get(pin)
+        if detection is None:
+            return
+        edge, callback, bouncetime = detection
+        if edge == gpio_backend.BOTH or (edge == gpio_backend.RISING and level) or \
+                (edge == gpio_backend.FALLING and not level):
+            timestamp = message["time"]
+            last = self._last_callback.get(pin)
+            if bouncetime and last is not None and (timestamp - last) * 1000 < bouncetime:
+                return
+            self._last_callback[pin] = timestamp
+            callback(pin, timestamp)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shares the filament sensor pins between OctoPrint instances")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket the instances connect to")
+    parser.add_argument("--group", help="group allowed to connect, the OctoPrint users have to be in it")
+    parser.add_argument("--socket-mode", type=lambda value: int(value, 8), default=0o660,
+                        help="permissions of the socket, octal")
+    parser.add_argument("--backend", default="rpigpio", choices=sorted(gpio_backend.BACKENDS),
+                        help="GPIO backend the daemon uses")
+    parser.add_argument("--mode", default="board", choices=("board", "bcm"),
+                        help="pin numbering on the socket, instances may use the other one")
+    parser.add_argument("--poll-ms", type=float, default=20, help="delay between two polls of every pin")
+    parser.add_argument("--bounce-ms", type=int, default=1, help="bounce time of the edge detection")
+    parser.add_argument("--chip", default="/dev/gpiochip0", help="GPIO chip of the gpiod backends")
+    parser.add_argument("--kernel-debounce", type=int, default=10, help="longest kernel debounce of the gpiod backends, in ms")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    options = {}
+    if args.backend in gpio_backend.CHARDEV_BACKENDS:
+        options = dict(chip=args.chip, debounce=args.kernel_debounce)
+    backend = gpio_backend.create_backend(args.backend, **options)
+    backend.setwarnings(True)
+    mode = gpio_backend.BOARD if args.mode == "board" else gpio_backend.BCM
+    daemon = SensorDaemon(backend, mode, args.socket, args.poll_ms / 1000.0, args.bounce_ms, socket_mode=args.socket_mode,
+                          group=args.group)
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    daemon.start()
+    try:
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        backend.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+
+class DebounceFilter(object):
+    # turns a stream of raw boolean reads into a settled value, update() returns the settled value
+    # or None while the filter is still undecided
+
+    def __init__(self, deadline=None):
+        # seconds after reset() when the filter has to decide, None waits as long as it takes
+        self.deadline = deadline
+        # number of times a read disagreed with the previous one, a measure of sensor bounce
+        self.flips = 0
+        self.reset()
+
+    # starts a new decision, current is the last settled value if there is one
+    def reset(self, current=None, now=None):
+        self.started = now
+        self.previous = None
+        self.ones = 0
+        self.total = 0
+
+    def update(self, value, now):
+        if self.started is None:
+            self.started = now
+        flipped = self.previous is not None and value != self.previous
+        if flipped:
+            self.flips += 1
+        self.previous = value
+        self.total += 1
+        if value:
+            self.ones += 1
+
+        decision = self._update(value, flipped)
+        if decision is None and self.deadline is not None and now - self.started >= self.deadline:
+            # out of time, go with what most of the reads said
+            zeros = self.total - self.ones
+            decision = value if self.ones == zeros else self.ones > zeros
+        return decision
+
+    # flipped tells whether the value differs from the previous read since reset()
+    def _update(self, value, flipped):
+        raise NotImplementedError()
+
+
+class ConsecutiveFilter(DebounceFilter):
+    # legacy behaviour: the same value read `count` times in a row, any flip starts the count again
+
+    def __init__(self, count=10, deadline=None):
+        self.count = count
+        DebounceFilter.__init__(self, deadline)
+
+    def reset(self, current=None, now=None):
+        DebounceFilter.reset(self, current, now)
+        self.streak = 0
+
+    def _update(self, value, flipped):
+        if flipped:
+            self.streak = 0
+        self.streak += 1
+        return value if self.streak >= self.count else None
+
+
+class MajorityFilter(DebounceFilter):
+    # majority of the last `window` reads, decides as soon as the window is full
+
+    def __init__(self, window=9, deadline=None):
+        self.window = window
+        DebounceFilter.__init__(self, deadline)
+
+    def reset(self, current=None, now=None):
+        DebounceFilter.reset(self, current, now)
+        self.samples = [False] * self.window
+        self.position = 0
+        self.filled = 0
+        self.window_ones = 0
+
+    def _update(self, value, flipped):
+        if self.filled == self.window:
+            self.window_ones -= self.samples[self.position]
+        else:
+            self.filled += 1
+        self.samples[self.position] = value
+        self.window_ones += value
+        self.position = (self.position + 1) % self.window
+        if self.filled < self.window:
+            return None
+        zeros = self.window - self.window_ones
+        if self.window_ones == zeros:
+            return None
+        return self.window_ones > zeros
+
+
+class IntegratorFilter(DebounceFilter):
+    # counter going up on True and down on False reads, the value changes only when the counter hits
+    # one of its limits, so a single bounce can never flip it
+
+    def __init__(self, window=9, deadline=None):
+        self.limit = window
+        DebounceFilter.__init__(self, deadline)
+
+    def reset(self, current=None, now=None):
+        DebounceFilter.reset(self, current, now)
+        if current is None:
+            self.integrator = self.limit // 2
+        else:
+            self.integrator = self.limit if current else 0
+
+    def _update(self, value, flipped):
+        if value:
+            self.integrator = min(self.limit, self.integrator + 1)
+        else:
+            self.integrator = max(0, self.integrator - 1)
+        if self.integrator == self.limit:
+            return True
+        if self.integrator == 0:
+            return False
+        return None
+
+
+class VoteFilter(DebounceFilter):
+    # decides once `threshold` of at most `window` reads agree, after `window` reads or the deadline
+    # the majority wins
+
+    def __init__(self, window=9, threshold=6, deadline=None):
+        self.window = window
+        self.threshold = min(threshold, window)
+        DebounceFilter.__init__(self, deadline)
+
+    def _update(self, value, flipped):
+        if self.ones >= self.threshold:
+            return True
+        if self.total - self.ones >= self.threshold:
+            return False
+        if self.total >= self.window:
+            zeros = self.total - self.ones
+            return value if self.ones == zeros else self.ones > zeros
+        return None
+
+
+# debounce modes selectable in settings
+FILTERS = dict(
+    consecutive=lambda window, threshold, deadline: ConsecutiveFilter(window, deadline),
+    majority=lambda window, threshold, deadline: MajorityFilter(window, deadline),
+    integrator=lambda window, threshold, deadline: IntegratorFilter(window, deadline),
+    vote=lambda window, threshold, deadline: VoteFilter(window, threshold, deadline)
+)
+
+
+# returns a function creating new filters of the given mode, deadline is in seconds
+def filter_factory(mode, window, threshold=None, deadline=None):
+    if mode not in FILTERS:
+        raise ValueError("Unknown debounce mode %s" % mode)
+    window = max(1, int(window))
+    threshold = window // 2 + 1 if threshold is None else max(1, int(threshold))
+    create = FILTERS[mode]
+    return lambda: create(window, threshold, deadline)
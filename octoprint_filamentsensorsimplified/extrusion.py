@@ -0,0 +1,119 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import collections
+
+
+# value of the E parameter of a gcode line or None, lines come from OctoPrint without line numbers,
+# checksums and comments
+def e_value(cmd):
+    head, separator, tail = cmd.partition(" E")
+    if not separator:
+        return None
+    try:
+        return float(tail.split(" ", 1)[0])
+    except ValueError:
+        return None
+
+
+class ExtrusionTracker(object):
+    # follows the E axis through the gcode sent to the printer, feed() only looks at the few commands that
+    # move or redefine E and does a dictionary lookup for everything else
+
+    def __init__(self):
+        # filament pushed forward since start in mm, retractions count negative
+        self.extruded = 0.0
+        # E position as the printer knows it, only meaningful in absolute mode
+        self.position = 0.0
+        self.relative = False
+        self._handlers = {
+            "G0": self._move,
+            "G1": self._move,
+            "G2": self._move,
+            "G3": self._move,
+            "G92": self._set_position,
+            "G90": self._absolute,
+            "G91": self._relative,
+            "M82": self._absolute,
+            "M83": self._relative
+        }
+
+    # gcode is the command code OctoPrint passes to the hooks (e.g. G1), cmd the whole line
+    def feed(self, gcode, cmd):
+        handler = self._handlers.get(gcode)
+        if handler is not None:
+            handler(cmd)
+
+    def _move(self, cmd):
+        e = e_value(cmd)
+        if e is None:
+            return
+        if self.relative:
+            self.extruded += e
+        else:
+            self.extruded += e - self.position
+            self.position = e
+
+    def _set_position(self, cmd):
+        e = e_value(cmd)
+        if e is not None:
+            self.position = e
+        elif cmd.strip() == "G92":
+            # G92 without parameters zeroes every axis
+            self.position = 0.0
+
+    # G90/G91 switch E together with the other axes, M82/M83 only E, whichever came last wins
+    def _absolute(self, cmd):
+        self.relative = False
+
+    def _relative(self, cmd):
+        self.relative = True
+
+
+class JamDetector(object):
+    # compares the extrusion sent to the printer with the filament movement measured by an encoder
+    # (motion sensor) over a sliding window of the last `window` mm of commanded extrusion. The window moves
+    # in `steps` steps, check() does real work only when the commanded extrusion crossed the next step.
+
+    def __init__(self, tracker, mm_per_pulse, window, min_ratio, steps=4):
+        self.tracker = tracker
+        # filament length per encoder pulse in mm
+        self.mm_per_pulse = mm_per_pulse
+        # commanded extrusion the movement is measured over, in mm
+        self.window = window
+        # measured movement has to be at least this fraction of the commanded extrusion
+        self.min_ratio = min_ratio
+        self.step = float(window) / steps
+        # encoder pulses counted since start, incremented from the GPIO thread
+        self.pulses = 0
+        # (commanded extrusion, pulses) at the start of every step inside the window
+        self._marks = collections.deque(maxlen=steps + 1)
+        self._next_mark = 0.0
+        self.reset()
+
+    def pulse(self, *args):
+        self.pulses += 1
+
+    # starts a new window, e.g. after a filament change when the encoder wasn't watched
+    def reset(self):
+        extruded = self.tracker.extruded
+        self._marks.clear()
+        self._marks.append((extruded, self.pulses))
+        self._next_mark = extruded + self.step
+
+    # returns (commanded mm, measured mm) when the filament didn't move as much as it should, None otherwise
+    def check(self):
+        extruded = self.tracker.extruded
+        if extruded < self._next_mark:
+            return None
+        pulses = self.pulses
+        self._marks.append((extruded, pulses))
+        self._next_mark = extruded + self.step
+        start_extruded, start_pulses = self._marks[0]
+        commanded = extruded - start_extruded
+        if commanded < self.window:
+            return None
+        measured = (pulses - start_pulses) * self.mm_per_pulse
+        if measured < commanded * self.min_ratio:
+            return commanded, measured
+        return None
@@ -0,0 +1,307 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import random
+import threading
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # python 2
+    from time import time as monotonic
+
+from . import pins
+
+# constants mirror RPi.GPIO so the stored settings (gpio_mode 10/11) keep their meaning with every backend, the
+# numbering modes come with the pin table
+BOARD = pins.BOARD
+BCM = pins.BCM
+UNKNOWN = -1
+OUT = 0
+IN = 1
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+class GPIOBackend(object):
+    # everything the plugin does with GPIO goes through one of these
+
+    name = None
+
+    def setwarnings(self, enabled):
+        pass
+
+    # P1 header revision as RPi.GPIO reports it, 3 is the 40 pin header of every current board
+    def board_revision(self):
+        return 3
+
+    # BOARD, BCM or None if nobody set the mode yet
+    def getmode(self):
+        raise NotImplementedError()
+
+    def setmode(self, mode):
+        raise NotImplementedError()
+
+    def cleanup(self):
+        raise NotImplementedError()
+
+    # gives a single pin back: edge detection goes and the pin is no longer set up, other pins are left alone
+    def release(self, pin):
+        raise NotImplementedError()
+
+    # IN, OUT or another function, raises ValueError for power, ground and out of range pins
+    def gpio_function(self, pin):
+        raise NotImplementedError()
+
+    def setup_input(self, pin, pull_up_down):
+        raise NotImplementedError()
+
+    def input(self, pin):
+        raise NotImplementedError()
+
+    # callback(pin, timestamp) is called from a backend thread, timestamp is the time of the edge on the
+    # monotonic clock, raises RuntimeError if edge detection can't be added
+    def add_event_detect(self, pin, edge, callback, bouncetime):
+        raise NotImplementedError()
+
+    def remove_event_detect(self, pin):
+        raise NotImplementedError()
+
+
+class RPiGPIOBackend(GPIOBackend):
+    name = "rpigpio"
+
+    def __init__(self):
+        import RPi.GPIO
+        if RPi.GPIO.VERSION < "0.6":
+            # Need at least 0.6 for edge detection
+            raise RuntimeError("RPi.GPIO %s is too old, at least 0.6 is needed" % RPi.GPIO.VERSION)
+        self._gpio = RPi.GPIO
+
+    def setwarnings(self, enabled):
+        self._gpio.setwarnings(enabled)
+
+    def board_revision(self):
+        return getattr(self._gpio, "RPI_INFO", {}).get("P1_REVISION", 3)
+
+    def getmode(self):
+        return self._gpio.getmode()
+
+    def setmode(self, mode):
+        self._gpio.setmode(mode)
+
+    def cleanup(self):
+        self._gpio.cleanup()
+
+    def release(self, pin):
+        self._gpio.remove_event_detect(pin)
+        self._gpio.cleanup(pin)
+
+    def gpio_function(self, pin):
+        return self._gpio.gpio_function(pin)
+
+    def setup_input(self, pin, pull_up_down):
+        self._gpio.setup(pin, self._gpio.IN, pull_up_down=pull_up_down)
+
+    def input(self, pin):
+        return self._gpio.input(pin)
+
+    def add_event_detect(self, pin, edge, callback, bouncetime):
+        self._gpio.add_event_detect(pin, edge, callback=lambda channel: callback(channel, monotonic()),
+                                    bouncetime=bouncetime)
+
+    def remove_event_detect(self, pin):
+        self._gpio.remove_event_detect(pin)
+
+
+class SimulatedGPIOBackend(GPIOBackend):
+    # in-process pin driver for running the plugin off a Raspberry Pi, pins follow their pull resistor
+    # unless driven by set_level() or a scripted pattern passed to play()
+
+    name = "simulated"
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._mode = None
+        self._functions = {}
+        self._pulls = {}
+        self._driven = {}
+        self._detections = {}
+        self._last_callback = {}
+        # number of input() calls, lets benchmarks count reads
+        self.reads = 0
+
+    def getmode(self):
+        return self._mode
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    def cleanup(self):
+        with self._lock:
+            self._mode = None
+            self._functions.clear()
+            self._pulls.clear()
+            self._detections.clear()
+
+    def release(self, pin):
+        with self._lock:
+            self._functions.pop(pin, None)
+            self._pulls.pop(pin, None)
+            self._detections.pop(pin, None)
+
+    def _check_pin(self, pin):
+        if self._mode is None:
+            raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+        if not pins.pin_index(self.board_revision()).valid(self._mode, pin):
+            raise ValueError("The channel sent is invalid on a Raspberry Pi")
+
+    def gpio_function(self, pin):
+        self._check_pin(pin)
+        return self._functions.get(pin, IN)
+
+    # pretend another program took the pin
+    def set_function(self, pin, function):
+        self._functions[pin] = function
+
+    def setup_input(self, pin, pull_up_down):
+        self._check_pin(pin)
+        with self._lock:
+            self._functions[pin] = IN
+            self._pulls[pin] = pull_up_down
+
+    def level(self, pin):
+        driven = self._driven.get(pin)
+        if driven is not None:
+            return driven
+        return 1 if self._pulls.get(pin) == PUD_UP else 0
+
+    def input(self, pin):
+        self._check_pin(pin)
+        self.reads += 1
+        return self.level(pin)
+
+    def add_event_detect(self, pin, edge, callback, bouncetime):
+        self._check_pin(pin)
+        with self._lock:
+            if pin in self._detections:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self._detections[pin] = (edge, callback, bouncetime)
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._detections.pop(pin, None)
+
+    # drives the pin from outside, None releases it back to its pull resistor
+    def set_level(self, pin, level):
+        with self._lock:
+            old = self.level(pin)
+            self._driven[pin] = level
+            new = self.level(pin)
+            detection = self._detections.get(pin)
+        if detection is None or old == new:
+            return
+        edge, callback, bouncetime = detection
+        if edge == BOTH or (edge == RISING and new) or (edge == FALLING and not new):
+            # software bounce time like RPi.GPIO, callbacks closer than bouncetime ms are dropped
+            now = time.time()
+            last = self._last_callback.get(pin)
+            if bouncetime and last is not None and (now - last) * 1000 < bouncetime:
+                return
+            self._last_callback[pin] = now
+            callback(pin, monotonic())
+
+    # replays [(seconds from start, level), ...] on a background thread, rate > 1 plays faster
+    def play(self, pin, script, rate=1.0):
+        def replay():
+            start = time.time()
+            for at, level in script:
+                delay = start + at / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self.set_level(pin, level)
+
+        thread = threading.Thread(target=replay, name="filamentsensorsimplified-simulated-%s" % pin)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+# script for SimulatedGPIOBackend.play: `bounces` random flips within `duration` seconds after `at`,
+# ending at `level`
+def bounce_script(level, at=0.0, bounces=5, duration=0.005, seed=None):
+    rng = random.Random(seed)
+    times = sorted(at + rng.uniform(0, duration) for _ in range(bounces))
+    script = []
+    current = level
+    for moment in times:
+        script.append((moment, current))
+        current = 1 - current
+    script.append((at + duration, level))
+    return script
+
+
+def _gpiod_backend(**options):
+    from .chardev import GpiodBackend
+    return GpiodBackend(**options)
+
+
+def _gpiod_mock_backend(**options):
+    from .chardev import GpiodBackend, mock_gpiod
+    return GpiodBackend(gpiod=mock_gpiod, **options)
+
+
+def _daemon_backend(**options):
+    from .daemon import DaemonBackend
+    return DaemonBackend(**options)
+
+
+BACKENDS = dict(
+    rpigpio=RPiGPIOBackend,
+    simulated=SimulatedGPIOBackend,
+    gpiod=_gpiod_backend,
+    # character device backend running against an in-process stand-in of the kernel interface
+    gpiod_mock=_gpiod_mock_backend,
+    # pins owned by the sensor daemon shared with other OctoPrint instances on the host
+    daemon=_daemon_backend
+)
+
+# library a backend needs, looked up before the backend is created
+LIBRARIES = dict(
+    rpigpio="RPi.GPIO",
+    gpiod="gpiod"
+)
+
+# backends taking the chip and kernel debounce options
+CHARDEV_BACKENDS = ("gpiod", "gpiod_mock")
+
+# Unix socket the sensor daemon listens on unless told otherwise, in a runtime directory owned by the daemon's user
+# (e.g. systemd's RuntimeDirectory) so no other user can bind it first
+DEFAULT_SOCKET = "/run/filamentsensorsimplified/daemon.sock"
+
+
+def module_available(name):
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        # python 2
+        import pkgutil
+        return pkgutil.find_loader(name) is not None
+    try:
+        return find_spec(name) is not None
+    except ImportError:
+        # parent package missing
+        return False
+
+
+# raises ValueError for unknown backends and RuntimeError when the library of the backend isn't installed
+def create_backend(name, **options):
+    if name not in BACKENDS:
+        raise ValueError("Unknown GPIO backend %s" % name)
+    library = LIBRARIES.get(name)
+    if library is not None and not module_available(library):
+        raise RuntimeError("The %s GPIO backend needs %s, which is not installed" % (name, library))
+    return BACKENDS[name](**options)
@@ -0,0 +1,369 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import collections
+import errno
+import os
+import struct
+import threading
+import time
+
+# event kinds, the value of an event depends on its kind
+JOB_STARTED = 1
+# value: how the job ended, see JOB_RESULTS
+JOB_ENDED = 2
+# value: ms from the sensor edge to the runout action, -1 when the edge wasn't seen (polled sensors)
+RUNOUT = 3
+# a read disagreed with the settled state and the sensor settled again
+DEBOUNCE_RESTART = 4
+DELIBERATE_M600 = 5
+PAUSED_FOR_USER = 6
+# value: seconds from the printer asking for filament to the change ending, the operator response time
+CHANGE_ENDED = 7
+
+KIND_NAMES = {
+    JOB_STARTED: "job_started",
+    JOB_ENDED: "job_ended",
+    RUNOUT: "runout",
+    DEBOUNCE_RESTART: "debounce_restart",
+    DELIBERATE_M600: "deliberate_m600",
+    PAUSED_FOR_USER: "paused_for_user",
+    CHANGE_ENDED: "change_ended"
+}
+
+JOB_RESULTS = ("done", "failed", "cancelled", "error")
+
+# time, job, kind, sensor index (NO_SENSOR if none), value
+RECORD = struct.Struct("<dIBBxxf")
+NO_SENSOR = 255
+
+# job number, start time, name (utf-8, cut to fit)
+JOB = struct.Struct("<Id64s")
+
+# every segment starts with a header: magic, version, record size, sequence number of its first record
+HEADER = struct.Struct("<4sHHQ")
+MAGIC = b"FSSH"
+VERSION = 1
+
+
+class _Segment(object):
+    __slots__ = ("path", "first", "count")
+
+    def __init__(self, path, first, count):
+        self.path = path
+        # sequence number of the first record
+        self.first = first
+        self.count = count
+
+    @property
+    def end(self):
+        return self.first + self.count
+
+
+class _JobSummary(object):
+    __slots__ = ("job", "first", "last", "start", "end", "result", "runouts", "m600", "pauses", "restarts",
+                 "response_total", "responses")
+
+    def __init__(self, job, seq):
+        self.job = job
+        # sequence numbers of the first and last record of the job, the records of a job are contiguous
+        self.first = seq
+        self.last = seq
+        self.start = None
+        self.end = None
+        self.result = None
+        self.runouts = 0
+        self.m600 = 0
+        self.pauses = 0
+        self.restarts = 0
+        self.response_total = 0.0
+        self.responses = 0
+
+    def add(self, seq, timestamp, kind, value):
+        self.last = seq
+        if kind == JOB_STARTED:
+            self.start = timestamp
+        elif kind == JOB_ENDED:
+            self.end = timestamp
+            index = int(value)
+            self.result = JOB_RESULTS[index] if 0 <= index < len(JOB_RESULTS) else None
+        elif kind == RUNOUT:
+            self.runouts += 1
+        elif kind == DELIBERATE_M600:
+            self.m600 += 1
+        elif kind == PAUSED_FOR_USER:
+            self.pauses += 1
+        elif kind == DEBOUNCE_RESTART:
+            self.restarts += 1
+        elif kind == CHANGE_ENDED and value >= 0:
+            self.response_total += value
+            self.responses += 1
+
+    def to_dict(self, name):
+        return dict(job=self.job, name=name, start=self.start, end=self.end, result=self.result,
+                    runouts=self.runouts, m600=self.m600, pauses=self.pauses, restarts=self.restarts,
+                    responseTime=self.response_total / self.responses if self.responses else None)
+
+
+class EventLog(object):
+    # append-only log of runout related events in fixed size records. The log is split into segments of at most
+    # max_bytes, the oldest is dropped when there are more than `backups` besides the current one. Records carry
+    # the print job they happened in, the per-job summary used by queries is built from the segments on the first
+    # query and kept up to date as records are written. Job names live in a separate file of fixed size records.
+    # record() only queues, a writer thread does the file writes so the comm thread never waits for the disk.
+
+    def __init__(self, folder, max_bytes=1024 * 1024, backups=3, max_jobs=4096, logger=None):
+        self.folder = folder
+        self.max_bytes = max(max_bytes, HEADER.size + RECORD.size)
+        self.backups = backups
+        self.max_jobs = max_jobs
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._file = None
+        self._segments = []
+        self._summaries = None
+        self._names = {}
+        self.job = 0
+        self._last_job = 0
+        self._failed = False
+        # (timestamp, job, kind, value, packed record) waiting for the writer
+        self._queue = collections.deque()
+        self._pending = threading.Event()
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self._open()
+        except (IOError, OSError) as e:
+            self._fail(e)
+            return
+        writer = threading.Thread(target=self._write_loop, name="filamentsensorsimplified-history")
+        writer.daemon = True
+        writer.start()
+
+    def _path(self, generation):
+        return os.path.join(self.folder, "events.bin" if generation == 0 else "events.%d.bin" % generation)
+
+    @property
+    def _jobs_path(self):
+        return os.path.join(self.folder, "jobs.bin")
+
+    def _open(self):
+        segments = []
+        for generation in range(self.backups, -1, -1):
+            segment = self._read_segment(self._path(generation))
+            if segment is not None:
+                segments.append(segment)
+        current = segments[-1] if segments and segments[-1].path == self._path(0) else None
+        if current is None:
+            first = segments[-1].end if segments else 0
+            current = self._create_segment(first)
+            segments.append(current)
+        self._segments = segments
+        self._file = open(current.path, "ab")
+        self._load_jobs()
+
+    def _read_segment(self, path):
+        try:
+            size = os.path.getsize(path)
+            with open(path, "rb") as f:
+                header = f.read(HEADER.size)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        if len(header) < HEADER.size:
+            return None
+        magic, version, record_size, first = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            if self._logger is not None:
+                self._logger.warn("Ignoring history segment %s in an unknown format" % path)
+            return None
+        count = (size - HEADER.size) // RECORD.size
+        if HEADER.size + count * RECORD.size != size:
+            # partly written record at the end, e.g. after a power cut
+            with open(path, "r+b") as f:
+                f.truncate(HEADER.size + count * RECORD.size)
+        return _Segment(path, first, count)
+
+    def _create_segment(self, first):
+        path = self._path(0)
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, first))
+        return _Segment(path, first, 0)
+
+    def _load_jobs(self):
+        try:
+            with open(self._jobs_path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            data = b""
+        for offset in range(0, len(data) - len(data) % JOB.size, JOB.size):
+            job, start, name = JOB.unpack_from(data, offset)
+            self._names[job] = name.rstrip(b"\0").decode("utf-8", "ignore")
+            self._last_job = max(self._last_job, job)
+
+    def _fail(self, e):
+        self._failed = True
+        if self._logger is not None:
+            self._logger.warn("Runout history disabled: %s" % e)
+
+    def _rotate(self):
+        self._file.close()
+        for generation in range(self.backups, 0, -1):
+            if os.path.exists(self._path(generation - 1)):
+                os.rename(self._path(generation - 1), self._path(generation))
+        first = self._segments[-1].end
+        self._segments = [segment for segment in self._segments[-self.backups:]] if self.backups else []
+        for generation, segment in enumerate(reversed(self._segments)):
+            segment.path = self._path(generation + 1)
+        segment = self._create_segment(first)
+        self._segments.append(segment)
+        self._file = open(segment.path, "ab")
+        if self._summaries is not None:
+            oldest = self._segments[0].first
+            for job in [job for job, summary in self._summaries.items() if summary.last < oldest]:
+                del self._summaries[job]
+
+    def record(self, kind, value=0.0, sensor=None, timestamp=None):
+        if self._failed:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        job = self.job
+        data = RECORD.pack(timestamp, job, kind, NO_SENSOR if sensor is None else sensor, value)
+        self._queue.append((timestamp, job, kind, value, data))
+        self._pending.set()
+
+    def _write_loop(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            with self._lock:
+                if self._file is None:
+                    return
+                self._write_queued()
+
+    # writes the queued records with a single flush, called with the lock held
+    def _write_queued(self):
+        if not self._queue or self._failed:
+            return
+        try:
+            while self._queue:
+                timestamp, job, kind, value, data = self._queue.popleft()
+                segment = self._segments[-1]
+                if HEADER.size + (segment.count + 1) * RECORD.size > self.max_bytes:
+                    self._rotate()
+                    segment = self._segments[-1]
+                self._file.write(data)
+                seq = segment.end
+                segment.count += 1
+                if self._summaries is not None:
+                    self._summarize(seq, timestamp, job, kind, value)
+            self._file.flush()
+        except (IOError, OSError) as e:
+            self._fail(e)
+
+    # a new print job, returns its number
+    def start_job(self, name=None):
+        with self._lock:
+            self._last_job += 1
+            job = self.job = self._last_job
+            name = (name or "")[:64]
+            self._names[job] = name
+            if not self._failed:
+                try:
+                    self._append_job(JOB.pack(job, time.time(), name.encode("utf-8")[:64]))
+                except (IOError, OSError) as e:
+                    self._fail(e)
+        self.record(JOB_STARTED)
+        return job
+
+    def end_job(self, result):
+        if self.job == 0:
+            return
+        self.record(JOB_ENDED, JOB_RESULTS.index(result) if result in JOB_RESULTS else -1)
+        self.job = 0
+
+    def _append_job(self, data):
+        path = self._jobs_path
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size + len(data) > self.max_jobs * JOB.size:
+            # keep the newest half
+            with open(path, "rb") as f:
+                f.seek(size - size % JOB.size - (self.max_jobs // 2) * JOB.size)
+                kept = f.read()
+            with open(path, "wb") as f:
+                f.write(kept)
+        with open(path, "ab") as f:
+            f.write(data)
+
+    def _records(self, segment, start, stop):
+        with open(segment.path, "rb") as f:
+            f.seek(HEADER.size + (start - segment.first) * RECORD.size)
+            data = f.read((stop - start) * RECORD.size)
+        return [RECORD.unpack_from(data, offset) for offset in range(0, len(data) - len(data) % RECORD.size,
+                                                                        RECORD.size)]
+
+    def _summarize(self, seq, timestamp, job, kind, value):
+        if job == 0:
+            return
+        summary = self._summaries.get(job)
+        if summary is None:
+            summary = self._summaries[job] = _JobSummary(job, seq)
+        summary.add(seq, timestamp, kind, value)
+
+    def _build_summaries(self):
+        self._summaries = {}
+        for segment in self._segments:
+            seq = segment.first
+            for timestamp, job, kind, sensor, value in self._records(segment, segment.first, segment.end):
+                self._summarize(seq, timestamp, job, kind, value)
+                seq += 1
+
+    # summaries of the newest jobs still in the log, newest first
+    def jobs(self, limit=None):
+        with self._lock:
+            self._write_queued()
+            if self._failed:
+                return []
+            if self._summaries is None:
+                self._build_summaries()
+            summaries = sorted(self._summaries.values(), key=lambda summary: summary.job, reverse=True)
+            if limit is not None:
+                summaries = summaries[:limit]
+            return [summary.to_dict(self._names.get(summary.job)) for summary in summaries]
+
+    # events of one job, only the segments holding its records are read
+    def events(self, job):
+        with self._lock:
+            self._write_queued()
+            if self._failed:
+                return None
+            if self._summaries is None:
+                self._build_summaries()
+            summary = self._summaries.get(job)
+            if summary is None:
+                return None
+            events = []
+            for segment in self._segments:
+                start = max(summary.first, segment.first)
+                stop = min(summary.last + 1, segment.end)
+                if start >= stop:
+                    continue
+                for timestamp, record_job, kind, sensor, value in self._records(segment, start, stop):
+                    if record_job != job:
+                        continue
+                    events.append(dict(time=timestamp, kind=KIND_NAMES.get(kind, kind),
+                                       sensor=None if sensor == NO_SENSOR else sensor, value=value))
+            return events
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._write_queued()
+                self._file.close()
+                self._file = None
+            self._failed = True
+        self._pending.set()
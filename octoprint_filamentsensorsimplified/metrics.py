@@ -0,0 +1,144 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+import threading
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(label, value, extra=None):
+    pairs = []
+    if label is not None and value is not None:
+        pairs.append('%s="%s"' % (label, _escape(value)))
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        # optional name of the single label the metric is split by
+        self.label = label
+        self._lock = threading.Lock()
+
+    def header(self):
+        return ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.type)]
+
+    def render(self):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, label=None):
+        Metric.__init__(self, name, documentation, label)
+        self._values = {}
+
+    def inc(self, amount=1, label_value=None):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: str(item[0]))
+        for label_value, value in values:
+            lines.append("%s%s %s" % (self.name, _labels(self.label, label_value), _format_value(value)))
+        return lines
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    # seconds, from sub-microsecond hook calls up to multi-second sensor reads
+    default_buckets = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, label=None, buckets=None):
+        Metric.__init__(self, name, documentation, label)
+        self.buckets = tuple(buckets or self.default_buckets)
+        self._series = {}
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # per bucket counts (last one is +Inf), sum
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            series = sorted(((label_value, list(counts), total) for label_value, (counts, total)
+                             in self._series.items()), key=lambda item: str(item[0]))
+        for label_value, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name, _labels(self.label, label_value,
+                                                                      ("le", _format_value(bound))), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _labels(self.label, label_value), repr(total)))
+            lines.append("%s_count%s %d" % (self.name, _labels(self.label, label_value), cumulative))
+        return lines
+
+
+class Gauge(Metric):
+    # value read at scrape time from a function returning {label value: value}
+    type = "gauge"
+
+    def __init__(self, name, documentation, label=None, collect=None):
+        Metric.__init__(self, name, documentation, label)
+        self._collect = collect
+
+    def render(self):
+        lines = self.header()
+        for label_value, value in sorted(self._collect().items(), key=lambda item: str(item[0])):
+            if value is not None:
+                lines.append("%s%s %s" % (self.name, _labels(self.label, label_value), _format_value(value)))
+        return lines
+
+
+class MetricsRegistry(object):
+    # metrics rendered in the Prometheus text exposition format
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label=None):
+        return self._add(Counter(self.prefix + name, documentation, label))
+
+    def histogram(self, name, documentation, label=None, buckets=None):
+        return self._add(Histogram(self.prefix + name, documentation, label, buckets))
+
+    def gauge(self, name, documentation, label=None, collect=None):
+        return self._add(Gauge(self.prefix + name, documentation, label, collect))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
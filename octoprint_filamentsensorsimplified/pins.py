@@ -0,0 +1,120 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# pin numbering modes, the values mirror RPi.GPIO so the stored settings (gpio_mode 10/11) keep their meaning
+BOARD = 10
+BCM = 11
+
+# P1 header layouts by board revision as RPi.GPIO reports it in RPI_INFO["P1_REVISION"]: 1 = first 26 pin boards,
+# 2 = later 26 pin boards, 3 = 40 pin header, BOARD pin to BCM channel
+HEADERS = {
+    1: {3: 0, 5: 1, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 21, 15: 22, 16: 23, 18: 24, 19: 10, 21: 9, 22: 25,
+        23: 11, 24: 8, 26: 7},
+    2: {3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23, 18: 24, 19: 10, 21: 9, 22: 25,
+        23: 11, 24: 8, 26: 7},
+    3: {3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23, 18: 24, 19: 10, 21: 9, 22: 25,
+        23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26, 38: 20, 40: 21}
+}
+
+DEFAULT_REVISION = 3
+
+# BOARD pins wired to 3.3V/5V and to ground
+POWER_PINS = (1, 2, 4, 17)
+GROUND_PINS = (6, 9, 14, 20, 25, 30, 34, 39)
+
+# I2C pins with fixed 1.8k pull-ups on the board, a sensor connected to 3.3V can't pull them down
+FIXED_PULL_UP = frozenset((3, 5))
+
+# pins usable as inputs but better left alone
+NOTES = {
+    3: "I2C SDA, fixed pull-up",
+    5: "I2C SCL, fixed pull-up",
+    8: "UART TX",
+    10: "UART RX",
+    27: "HAT ID EEPROM",
+    28: "HAT ID EEPROM"
+}
+
+
+class PinInfo(object):
+    # one GPIO pin of the header in both numberings
+    __slots__ = ("board", "bcm", "pull_up", "note")
+
+    def __init__(self, board, bcm, pull_up, note):
+        self.board = board
+        self.bcm = bcm
+        # the pin has a pull-up on the board, only sensors connected to ground work
+        self.pull_up = pull_up
+        self.note = note
+
+    def to_dict(self):
+        return dict(board=self.board, bcm=self.bcm, pullUp=self.pull_up, note=self.note)
+
+    def __repr__(self):
+        return "PinInfo(board=%s, bcm=%s)" % (self.board, self.bcm)
+
+
+class PinIndex(object):
+    # what every pin of the header can be used for in both numbering modes, built once per board revision so
+    # validating a pin is a lookup instead of a GPIO probe
+
+    def __init__(self, revision):
+        if revision not in HEADERS:
+            revision = DEFAULT_REVISION
+        self.revision = revision
+        header = HEADERS[revision]
+        self.size = 40 if revision >= 3 else 26
+        self._pins = {BOARD: {}, BCM: {}}
+        for board, bcm in header.items():
+            info = PinInfo(board, bcm, board in FIXED_PULL_UP, NOTES.get(board))
+            self._pins[BOARD][board] = info
+            self._pins[BCM][bcm] = info
+        self.power = [pin for pin in POWER_PINS if pin <= self.size]
+        self.ground = [pin for pin in GROUND_PINS if pin <= self.size]
+        self._dict = self._build_dict()
+
+    # PinInfo of an input pin or None for power, ground and out of range pins
+    def lookup(self, mode, pin):
+        return self._pins.get(mode, {}).get(pin)
+
+    def valid(self, mode, pin):
+        return self.lookup(mode, pin) is not None
+
+    # pins a sensor can be connected to, 0 is left out as it disables a sensor in the settings
+    def input_pins(self, mode):
+        return sorted(pin for pin in self._pins.get(mode, ()) if pin != 0)
+
+    # same pin in another numbering mode, None if it has no counterpart
+    def convert(self, pin, from_mode, to_mode):
+        if from_mode == to_mode:
+            return pin
+        info = self.lookup(from_mode, pin)
+        if info is None:
+            return None
+        return info.bcm if to_mode == BCM else info.board
+
+    def _build_dict(self):
+        modes = {}
+        for mode, pins in self._pins.items():
+            modes[str(mode)] = dict(pins=self.input_pins(mode),
+                                    max=max(pins),
+                                    pullUp=[pin for pin in self.input_pins(mode) if pins[pin].pull_up],
+                                    notes=dict((str(pin), pins[pin].note) for pin in self.input_pins(mode)
+                                               if pins[pin].note))
+        return dict(revision=self.revision, size=self.size, power=self.power, ground=self.ground, modes=modes,
+                    header=[self._pins[BOARD][board].to_dict() for board in sorted(self._pins[BOARD])])
+
+    # the table for the settings UI
+    def to_dict(self):
+        return self._dict
+
+
+_indexes = {}
+
+
+# shared PinIndex of a board revision
+def pin_index(revision=DEFAULT_REVISION):
+    index = _indexes.get(revision)
+    if index is None:
+        index = _indexes[revision] = PinIndex(revision)
+    return index
@@ -0,0 +1,225 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+from . import trace as tracing
+
+
+class FilamentState(object):
+    # debounced filament state together with the time it was last confirmed by a read
+    __slots__ = ("present", "timestamp")
+
+    def __init__(self, present, timestamp):
+        self.present = present
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return "FilamentState(present=%s, timestamp=%s)" % (self.present, self.timestamp)
+
+
+class _Channel(object):
+    # sampling bookkeeping of a single sensor
+    __slots__ = ("sensor", "read", "debounce", "settling", "poked", "next_read", "last_read", "restarted_from",
+                 "edge")
+
+    def __init__(self, sensor, read, debounce):
+        self.sensor = sensor
+        self.read = read
+        self.debounce = debounce
+        self.settling = True
+        self.poked = False
+        # the poke came from an edge on the pin
+        self.edge = False
+        self.next_read = 0
+        self.last_read = 0
+        # settled state a disagreeing read or an edge interrupted, None if nothing did
+        self.restarted_from = None
+
+    def restart(self, now, interrupted=False):
+        state = self.sensor.state
+        self.restarted_from = state.present if interrupted and state is not None else None
+        self.debounce.reset(self.sensor.present, now)
+        self.settling = True
+        self.next_read = now
+
+
+class SensorSampler(object):
+    # one background thread sampling every configured sensor and keeping their debounced states
+
+    # delay between reads while the state is stable, catches edges the edge detection missed
+    refresh_interval = 5.0
+
+    # delay before retrying after a failed read
+    error_interval = 5.0
+
+    def __init__(self, on_change, logger, debounce_factory, sample_interval, flips_counter=None, trace=None,
+                 poll_interval=None, on_restart=None):
+        # on_change(sensor, state) is called from the sampler thread whenever a debounced state flips
+        self._on_change = on_change
+        self._logger = logger
+        # creates the DebounceFilter of each sensor
+        self._debounce_factory = debounce_factory
+        # delay between reads while the state is settling, in seconds
+        self.sample_interval = sample_interval
+        # metrics Counter of reads disagreeing with the previous one while debouncing
+        self._flips_counter = flips_counter
+        # TraceBuffer getting every read and decision
+        self._trace = trace
+        # poll_interval() returns the delay between reads of a settled sensor without edge detection (sensor.polled)
+        self._poll_interval = poll_interval
+        self._reschedule = False
+        # on_restart(sensor) is called when a read or an edge disagreed with the settled state and the sensor
+        # settled back to that state, a bounce or glitch rather than a change
+        self._on_restart = on_restart
+        self._channels = {}
+        self._state_condition = threading.Condition()
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    # read() returns True when filament is present, sensors can be added and removed while running
+    def add(self, sensor, read):
+        self._channels[sensor.index] = _Channel(sensor, read, self._debounce_factory())
+
+    def remove(self, sensor):
+        channel = self._channels.get(sensor.index)
+        if channel is not None and channel.sensor is sensor:
+            del self._channels[sensor.index]
+
+    # new debounce settings, every sensor settles again with a fresh filter
+    def configure(self, debounce_factory, sample_interval):
+        self._debounce_factory = debounce_factory
+        self.sample_interval = sample_interval
+        for channel in list(self._channels.values()):
+            channel.debounce = debounce_factory()
+        self.poke()
+
+    # the poll interval changed, polled sensors waiting longer than the new interval are read earlier
+    def reschedule(self):
+        self._reschedule = True
+        self._wake.set()
+
+    def _stable_interval(self, channel):
+        if channel.sensor.polled and self._poll_interval is not None:
+            return self._poll_interval()
+        return self.refresh_interval
+
+    @property
+    def sensors(self):
+        return [channel.sensor for channel in self._channels.values()]
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="filamentsensorsimplified-sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(self.sample_interval * 2)
+        self._thread = None
+        with self._state_condition:
+            self._state_condition.notify_all()
+
+    # something happened on the pin (edge, end of filament change), settle the state again right away unless it
+    # is settling already, all sensors are resampled when no sensor is given
+    def poke(self, sensor=None, edge=False):
+        for channel in self._channels.values():
+            if sensor is None or channel.sensor is sensor:
+                channel.edge = channel.edge or edge
+                channel.poked = True
+        self._wake.set()
+
+    # blocks until the sensor has a state confirmed after newer_than, returns None on timeout
+    def wait_for_state(self, sensor, newer_than=None, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._state_condition:
+            while self._running:
+                state = sensor.state
+                if state is not None and (newer_than is None or state.timestamp > newer_than):
+                    return state
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._state_condition.wait(remaining)
+        return None
+
+    def _publish(self, sensor, present, timestamp):
+        previous = sensor.state
+        with self._state_condition:
+            sensor.state = FilamentState(present, timestamp)
+            self._state_condition.notify_all()
+        if previous is None or previous.present != present:
+            if self._trace is not None:
+                self._trace.record(tracing.STATE, sensor.name, present)
+            self._logger.info("%s: filament %s" % (sensor.name, "detected" if present else "not detected"))
+            try:
+                self._on_change(sensor, sensor.state)
+            except Exception:
+                self._logger.exception("Error while handling filament state change")
+
+    def _confirm(self, sensor, timestamp):
+        with self._state_condition:
+            sensor.state.timestamp = timestamp
+            self._state_condition.notify_all()
+
+    def _sample(self, channel, now):
+        sensor = channel.sensor
+        channel.last_read = now
+        try:
+            value = channel.read()
+        except Exception as e:
+            self._logger.warn("%s: reading sensor failed: %s" % (sensor.name, e))
+            if self._trace is not None:
+                self._trace.record(tracing.READ_ERROR, sensor.name, str(e))
+            channel.restart(now + self.error_interval)
+            return
+        if self._trace is not None:
+            self._trace.record(tracing.READ, sensor.name, value)
+
+        state = sensor.state
+        if not channel.settling:
+            if state is not None and value == state.present:
+                self._confirm(sensor, now)
+            else:
+                # stable state disagrees with a refresh read, settle again
+                channel.restart(now, True)
+        if channel.settling:
+            flips = channel.debounce.flips
+            decision = channel.debounce.update(value, now)
+            if self._flips_counter is not None and channel.debounce.flips != flips:
+                self._flips_counter.inc(1, sensor.name)
+            if decision is not None:
+                restarted_from, channel.restarted_from = channel.restarted_from, None
+                self._publish(sensor, decision, now)
+                channel.settling = False
+                if self._on_restart is not None and restarted_from == decision:
+                    self._on_restart(sensor)
+        channel.next_read = now + (self.sample_interval if channel.settling else self._stable_interval(channel))
+
+    def _run(self):
+        while self._running:
+            now = time.time()
+            next_read = now + self.refresh_interval
+            reschedule, self._reschedule = self._reschedule, False
+            for channel in list(self._channels.values()):
+                if reschedule and channel.sensor.polled and not channel.settling:
+                    channel.next_read = min(channel.next_read, channel.last_read + self._stable_interval(channel))
+                if channel.poked:
+                    channel.poked = False
+                    edge, channel.edge = channel.edge, False
+                    # a settling channel keeps its reads and start time, chatter can't push the deadline out
+                    if not channel.settling:
+                        channel.restart(now, edge)
+                if channel.next_read <= now:
+                    self._sample(channel, now)
+                next_read = min(next_read, channel.next_read)
+
+            if self._wake.wait(max(0, next_read - time.time())):
+                self._wake.clear()
@@ -0,0 +1,55 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+
+class Sensor(object):
+    # one runout sensor wired to a single pin, index 0 is the sensor configured by the top level settings,
+    # the others come from the extra_sensors list (usually one per extruder)
+
+    def __init__(self, index, name, pin, power, triggered, gcode):
+        self.index = index
+        self.name = name
+        self.pin = pin
+        # 0 = sensor connected to ground, 1 = sensor connected to 3.3V
+        self.power = power
+        # 0 = triggered when open, 1 = triggered when closed
+        self.triggered = triggered
+        # g-code sent when this sensor runs out of filament
+        self.gcode = gcode
+        # debounced FilamentState, maintained by the sampler
+        self.state = None
+        # monotonic time of the last edge seen on the pin
+        self.edge_time = None
+        # number of lines sent to the printer when that edge came in
+        self.edge_line = None
+        # edge detection couldn't be set up, the sampler polls the pin instead
+        self.polled = False
+
+    @classmethod
+    def from_settings(cls, index, data, default_gcode):
+        return cls(index,
+                   data.get("name") or "Extruder %s" % index,
+                   int(data.get("pin", 0)),
+                   int(data.get("power", 0)),
+                   int(data.get("triggered", 0)),
+                   data.get("g_code") or default_gcode)
+
+    # hardware related settings, a change of any of them requires the pin to be set up again
+    @property
+    def config(self):
+        return self.pin, self.power, self.triggered
+
+    @property
+    def present(self):
+        return None if self.state is None else self.state.present
+
+    def to_dict(self):
+        present = self.present
+        return dict(index=self.index,
+                    name=self.name,
+                    pin=self.pin,
+                    noFilament=None if present is None else not present,
+                    timestamp=None if self.state is None else self.state.timestamp)
+
+    def __repr__(self):
+        return "Sensor(index=%s, name=%r, pin=%s)" % (self.index, self.name, self.pin)
@@ -2,7 +2,8 @@ $(function () {
     function filamentsensorsimplifiedViewModel(parameters) {
         var self = this;
 
-        self.validPinsBoard = [3,5,7,11,13,15,19,21,23,27,29,31,33,35,37,8,10,12,16,18,22,24,26,28,32,36,38,40];
+        // Input pins, pull-up quirks and power/ground pins of the board by mode, served by the plugin
+        self.pinTable = ko.observable(null);
         self.settingsViewModel = parameters[0];
         self.testSensorResult = ko.observable(null);
         self.gpio_mode_disabled = ko.observable(false);
@@ -10,6 +11,26 @@ $(function () {
         self.gpio_mode_disabled_by_3rd = ko.computed(function() {
             return this.gpio_mode_disabled() && !this.printing();
         }, this);
+        // GPIO is set up in the background after startup: starting, ready or failed
+        self.readiness = ko.observable("starting");
+        self.readinessError = ko.observable(null);
+        self.ready = ko.computed(function() {
+            return this.readiness() == "ready";
+        }, this);
+        // Sequence number and epoch of the newest filament status seen, older pushes are dropped
+        self.statusSeq = null;
+        self.statusEpoch = null;
+        self.iconState = null;
+        // Sensor test running in the background and results that arrived before its id did
+        self.testJob = null;
+        self.testResults = {};
+        // Pin scan running in the background, its results are kept the same way
+        self.scanJob = null;
+        self.scanResults = {};
+        self.scanStatus = ko.observable("");
+        self.scanChanged = ko.observableArray([]);
+        // Also scan the UART, I2C and HAT EEPROM pins
+        self.scanAllPins = ko.observable(false);
 
         self.onDataUpdaterPluginMessage = function (plugin, data) {
             if (plugin !== "filamentsensorsimplified") {
@@ -18,7 +39,25 @@ $(function () {
 
             // Update icon
             if (data.type == "filamentStatus"){
-                self.updateIconStatus(data.noFilament);
+                self.applyStatus(data, false);
+                return;
+            }
+
+            // Background GPIO setup finished or failed
+            if (data.type == "readiness"){
+                self.applyReadiness(data.readiness, data.error);
+                return;
+            }
+
+            // Progress and result of a sensor test
+            if (data.type == "testSensor"){
+                self.testSensorUpdate(data);
+                return;
+            }
+
+            // Progress and result of a pin scan
+            if (data.type == "scanPins"){
+                self.scanPinsUpdate(data);
                 return;
             }
 
@@ -31,18 +70,135 @@ $(function () {
 
         }
 
-        self.updateIconStatus = function(noFilament){
+        // Pushes older than what we have are ignored, a snapshot with the same sequence number may still be newer
+        self.applyStatus = function(status, snapshot){
+            if (!status || status.seq === undefined){
+                return;
+            }
+            if (status.epoch === self.statusEpoch && self.statusSeq !== null){
+                if (status.seq < self.statusSeq || (status.seq == self.statusSeq && !snapshot)){
+                    return;
+                }
+            }
+            self.statusEpoch = status.epoch;
+            self.statusSeq = status.seq;
+            if (status.sensors && status.sensors.length){
+                self.updateIconStatus(status.noFilament, status.sensors);
+            }
+        }
+
+        self.fetchStatus = function(){
+            $.ajax({
+                type: "GET",
+                dataType: "json",
+                url: "plugin/filamentsensorsimplified/status",
+                success: function (result) {
+                    self.applyStatus(result, true);
+                }
+            });
+        }
+
+        self.applyReadiness = function(readiness, error){
+            var wasReady = self.ready();
+            self.readiness(readiness);
+            self.readinessError(error || null);
+            // Sensors only report once GPIO is set up
+            if (!wasReady && self.ready()){
+                self.fetchStatus();
+                self.fetchPins();
+            }
+        }
+
+        self.onStartupComplete = self.fetchStatus;
+        self.onServerReconnect = self.fetchStatus;
+
+        self.updateIconStatus = function(noFilament, sensors){
+            var title = noFilament ? 'Filament NOT detected' : 'Filament detected';
+            // With more sensors list the state of each of them
+            if (sensors && sensors.length > 1){
+                title = $.map(sensors, function(sensor){
+                    var state = sensor.noFilament === null ? 'unknown' : (sensor.noFilament ? 'NOT detected' : 'detected');
+                    return sensor.name + ': filament ' + state;
+                }).join('\n');
+            }
+            // Leave the navbar alone if nothing visible changed
+            var iconState = noFilament + '|' + title;
+            if (iconState === self.iconState){
+                return;
+            }
+            self.iconState = iconState;
             if (noFilament){
-                $('#navbar_plugin_filamentsensorsimplified a').html('<span class="fa-stack fa-1x"><i class="fas fa-life-ring fa-stack-1x"></i><i class="fas fa-ban fa-stack-2x text-error"></i></span>').attr('title','Filament NOT detected');
+                $('#navbar_plugin_filamentsensorsimplified a').html('<span class="fa-stack fa-1x"><i class="fas fa-life-ring fa-stack-1x"></i><i class="fas fa-ban fa-stack-2x text-error"></i></span>').attr('title',title);
+            } else {
+                $('#navbar_plugin_filamentsensorsimplified a').html('<i class="fas fa-life-ring fa-lg"></i>').attr('title',title);
+            }
+        }
+
+        self.addSensor = function () {
+            var sensors = self.settingsViewModel.settings.plugins.filamentsensorsimplified.extra_sensors;
+            sensors.push({
+                name: ko.observable("Extruder " + (sensors().length + 1)),
+                pin: ko.observable(0),
+                power: ko.observable(0),
+                triggered: ko.observable(0),
+                g_code: ko.observable("M600 X0 Y0")
+            });
+        }
+
+        self.removeSensor = function (sensor) {
+            self.settingsViewModel.settings.plugins.filamentsensorsimplified.extra_sensors.remove(sensor);
+        }
+
+        self.testSensorError = function (code) {
+            $("#filamentsensorsimplified_settings_testResult").addClass("alert-error");
+            if (code == 555) {
+                self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> This pin is already in use, choose other pin.');
+            } else if (code == 556) {
+                self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> The pin selected is power, ground or out of range pin number, choose other pin');
+            } else if (code == 503) {
+                self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> GPIO is not set up yet, try again in a moment.');
+            } else if (code == 409) {
+                self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> Another sensor test is still running, try again in a moment.');
+            } else if (code == 500) {
+                self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> OctoPrint experienced a problem. Check octoprint.log for further info.');
+            } else {
+                self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> There was an error :(');
+            }
+        }
+
+        self.testSensorDone = function (result) {
+            self.testJob = null;
+            $("#filamentsensorsimplified_settings_testResult").removeClass("alert-info alert-success alert-error");
+            if (result.error) {
+                self.testSensorError(result.error);
+            } else if (result.triggered === 0) {
+                $("#filamentsensorsimplified_settings_testResult").addClass("alert-success");
+                self.testSensorResult('<i class="fas icon-ok fa-check"></i> Sensor detected filament!');
+            } else if (result.triggered === 1) {
+                $("#filamentsensorsimplified_settings_testResult").addClass("alert-info");
+                self.testSensorResult('<i class="icon-stop"></i> Sensor triggered!')
+            }
+            $("#filamentsensorsimplified_settings_testResult").fadeIn();
+        }
+
+        self.testSensorUpdate = function (data) {
+            if (data.job !== self.testJob) {
+                if (data.done) {
+                    self.testResults[data.job] = data;
+                }
+                return;
+            }
+            if (data.done) {
+                self.testSensorDone(data);
             } else {
-                $('#navbar_plugin_filamentsensorsimplified a').html('<i class="fas fa-life-ring fa-lg"></i>').attr('title','Filament detected');
+                self.testSensorResult('<i class="fas fa-spinner fa-spin"></i> Reading sensor... ' + data.reads + ' reads, ' + data.flips + ' flips');
             }
         }
 
         self.testSensor = function () {
             // Cleanup
             $("#filamentsensorsimplified_settings_testResult").hide().removeClass("hide alert-warning alert-error alert-info alert-success");
-            // Make api callback
+            // Make api callback, the sensor is read in the background and the result pushed as a message
             $.ajax({
                     url: "/api/plugin/filamentsensorsimplified",
                     type: "post",
@@ -56,83 +212,178 @@ $(function () {
                         "mode": $("#filamentsensorsimplified_settings_gpioMode").val(),
                         "triggered": $("#filamentsensorsimplified_settings_triggeredInput").val()
                     }),
-                    statusCode: {
-                        500: function () {
-                            $("#filamentsensorsimplified_settings_testResult").addClass("alert-error");
-                            self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> OctoPrint experienced a problem. Check octoprint.log for further info.');
-                        },
-                        555: function () {
-                            $("#filamentsensorsimplified_settings_testResult").addClass("alert-error");
-                            self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> This pin is already in use, choose other pin.');
-                        },
-                        556: function () {
-                            $("#filamentsensorsimplified_settings_testResult").addClass("alert-error");
-                            self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> The pin selected is power, ground or out of range pin number, choose other pin');
-                        }
+                    error: function (xhr) {
+                        self.testSensorError(xhr.status);
+                        $("#filamentsensorsimplified_settings_testResult").fadeIn();
                     },
-                    error: function () {
-                        $("#filamentsensorsimplified_settings_testResult").addClass("alert-error");
-                        self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> There was an error :(');
+                    success: function (result) {
+                        // Active sensors are answered right away
+                        if (result.job === undefined) {
+                            self.testSensorDone(result);
+                            return;
+                        }
+                        self.testJob = result.job;
+                        if (self.testResults[result.job]) {
+                            self.testSensorDone(self.testResults[result.job]);
+                            self.testResults = {};
+                            return;
+                        }
+                        $("#filamentsensorsimplified_settings_testResult").addClass("alert-info");
+                        self.testSensorResult('<i class="fas fa-spinner fa-spin"></i> Reading sensor...');
+                        $("#filamentsensorsimplified_settings_testResult").fadeIn();
+                    }
+                }
+            );
+        }
+
+        self.scanPinsError = function (code) {
+            if (code == 503) {
+                self.scanStatus('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> GPIO is not set up yet, try again in a moment.');
+            } else if (code == 409) {
+                self.scanStatus('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> Another sensor test is still running, try again in a moment.');
+            } else if (code == 556) {
+                self.scanStatus('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> No free pin to scan in this board mode.');
+            } else if (code == 500) {
+                self.scanStatus('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> OctoPrint experienced a problem. Check octoprint.log for further info.');
+            } else {
+                self.scanStatus('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> There was an error :(');
+            }
+        }
+
+        self.scanPinsDone = function (result) {
+            self.scanJob = null;
+            if (result.error) {
+                self.scanPinsError(result.error);
+                return;
+            }
+            self.scanChanged(result.changed);
+            if (result.changed.length) {
+                self.scanStatus('<i class="fas icon-ok fa-check"></i> These pins changed state:');
+            } else {
+                self.scanStatus('<i class="icon-stop"></i> No pin changed state, insert and remove the filament while scanning.');
+            }
+        }
+
+        self.scanPinsUpdate = function (data) {
+            if (data.job !== self.scanJob) {
+                if (data.done) {
+                    self.scanResults[data.job] = data;
+                }
+                return;
+            }
+            if (data.done) {
+                self.scanPinsDone(data);
+            } else {
+                self.scanChanged(data.changed);
+            }
+        }
+
+        self.scanPins = function () {
+            self.scanChanged([]);
+            self.scanStatus('<i class="fas fa-spinner fa-spin"></i> Starting pin scan...');
+            // The pins are read in the background, changes and the result are pushed as messages
+            $.ajax({
+                    url: "/api/plugin/filamentsensorsimplified",
+                    type: "post",
+                    dataType: "json",
+                    contentType: "application/json",
+                    headers: {"X-Api-Key": UI_API_KEY},
+                    data: JSON.stringify({
+                        "command": "scanPins",
+                        "power": $("#filamentsensorsimplified_settings_powerInput").val(),
+                        "mode": $("#filamentsensorsimplified_settings_gpioMode").val(),
+                        "triggered": $("#filamentsensorsimplified_settings_triggeredInput").val(),
+                        "all": self.scanAllPins()
+                    }),
+                    error: function (xhr) {
+                        self.scanPinsError(xhr.status);
                     },
                     success: function (result) {
-                        if (result.triggered === 0) {
-                            $("#filamentsensorsimplified_settings_testResult").addClass("alert-success");
-                            self.testSensorResult('<i class="fas icon-ok fa-check"></i> Sensor detected filament!');
-                        } else if (result.triggered === 1) {
-                            $("#filamentsensorsimplified_settings_testResult").addClass("alert-info");
-                            self.testSensorResult('<i class="icon-stop"></i> Sensor triggered!')
+                        self.scanJob = result.job;
+                        if (self.scanResults[result.job]) {
+                            self.scanPinsDone(self.scanResults[result.job]);
+                            self.scanResults = {};
+                            return;
                         }
+                        self.scanStatus('<i class="fas fa-spinner fa-spin"></i> Scanning ' + result.pins.length + ' pins for ' + result.duration + ' s, insert and remove the filament now...');
                     }
                 }
-            ).always(function(){
-                $("#filamentsensorsimplified_settings_testResult").fadeIn();
-            });
+            );
+        }
+
+        self.useScannedPin = function (item) {
+            self.settingsViewModel.settings.plugins.filamentsensorsimplified.pin(item.pin);
+            $('#filamentsensorsimplified_settings_pinInput').trigger('change.fsensor');
         }
 
         self.checkWarningPullUp = function(event){
+            // Nothing to check against until the pin table arrived
+            if (!self.pinTable()){
+                return;
+            }
             // Which mode are we using
             var mode = parseInt($('#filamentsensorsimplified_settings_gpioMode').val(),10);
             // What pin is the sensor connected to
             var pin = parseInt($('#filamentsensorsimplified_settings_pinInput').val(),10);
             // What is the sensor connected to - ground or 3.3v
             var sensorCon = parseInt($('#filamentsensorsimplified_settings_powerInput').val(),10);
+            var pins = self.pinTable().modes[mode];
+            if (!pins){
+                return;
+            }
 
-            // Show alerts
-            if (
-                sensorCon == 1 && (
-                    (mode == 10 && (pin==3 || pin == 5))
-                    ||
-                    (mode == 11 && (pin == 2 || pin == 3))
-                )
-            ){
+            // Show alerts, pins with a pull-up on the board only work with sensors connected to ground
+            if (sensorCon == 1 && $.inArray(pin, pins.pullUp) != -1){
                 $('#filamentsensorsimplified_settings_pullupwarn').removeClass('hidden pulsAlert').addClass('pulsAlert');
             }else{
                 $('#filamentsensorsimplified_settings_pullupwarn').addClass('hidden').removeClass('pulsAlert');
             }
 
-            // Set max to right board type - 10 = Boardmode
-            var showWarning = true;
-            if (mode == 10){
-                $('#filamentsensorsimplified_settings_pinInput').attr('max',40);
-                if (pin != 0 && $.inArray(pin,self.validPinsBoard) == -1){
-                    showWarning = false;
-                    $('#filamentsensorsimplified_settings_badpin').removeClass('hidden pulsAlert').addClass('pulsAlert');
-                }else{
-                    $('#filamentsensorsimplified_settings_badpin').addClass('hidden').removeClass('pulsAlert');
-                }
+            // Set max to the highest pin of the mode and warn about power, ground and out of range pins
+            $('#filamentsensorsimplified_settings_pinInput').attr('max',pins.max);
+            if (pin != 0 && $.inArray(pin, pins.pins) == -1){
+                $('#filamentsensorsimplified_settings_badpin').removeClass('hidden pulsAlert').addClass('pulsAlert');
             }else{
-                $('#filamentsensorsimplified_settings_pinInput').attr('max',27);
+                $('#filamentsensorsimplified_settings_badpin').addClass('hidden').removeClass('pulsAlert');
             }
+        }
 
-            // High or low
-            if ($('#filamentsensorsimplified_settings_pinInput').attr('max') < pin || pin < 0){
-                $('#filamentsensorsimplified_settings_badpin').removeClass('hidden pulsAlert').addClass('pulsAlert');
-            }else{
-                // If the warning is not already shown then show it now
-                if (showWarning){
-                    $('#filamentsensorsimplified_settings_badpin').addClass('hidden').removeClass('pulsAlert');
-                }
+        // Pins of the selected board mode, null until the pin table arrived
+        self.modePins = ko.pureComputed(function(){
+            var table = self.pinTable();
+            if (!table){
+                return null;
             }
+            return table.modes[parseInt(self.settingsViewModel.settings.plugins.filamentsensorsimplified.gpio_mode(),10)] || null;
+        });
+
+        self.pinMax = ko.pureComputed(function(){
+            var pins = self.modePins();
+            return pins ? pins.max : 40;
+        });
+
+        // Same checks as the sensor pin above, for the additional sensors and the encoder
+        self.isBadPin = function(pin){
+            var pins = self.modePins();
+            pin = parseInt(ko.unwrap(pin),10);
+            return !!pins && pin != 0 && $.inArray(pin, pins.pins) == -1;
+        }
+
+        self.isPullUpPin = function(pin, power){
+            var pins = self.modePins();
+            return !!pins && parseInt(ko.unwrap(power),10) == 1 && $.inArray(parseInt(ko.unwrap(pin),10), pins.pullUp) != -1;
+        }
+
+        self.fetchPins = function(){
+            $.ajax({
+                type: "GET",
+                dataType: "json",
+                url: "plugin/filamentsensorsimplified/pins",
+                success: function (result) {
+                    self.pinTable(result);
+                    $('#filamentsensorsimplified_settings_gpioMode').trigger('change.fsensor');
+                }
+            });
         }
 
         self.getDisabled = function (item) {
@@ -143,16 +394,22 @@ $(function () {
                 success: function (result) {
                     self.gpio_mode_disabled(result.gpio_mode_disabled)
                     self.printing(result.printing)
+                    self.applyReadiness(result.readiness, result.error);
+                    self.applyStatus(result.status, true);
                 }
             });
         };
 
         self.onSettingsShown = function () {
             self.testSensorResult("");
+            self.scanStatus("");
+            self.scanChanged([]);
             self.getDisabled();
              // Check for broken settings
             $('#filamentsensorsimplified_settings_gpioMode, #filamentsensorsimplified_settings_pinInput, #filamentsensorsimplified_settings_powerInput').off('change.fsensor').on('change.fsensor',self.checkWarningPullUp);
             $('#filamentsensorsimplified_settings_gpioMode').trigger('change.fsensor');
+            // The table depends on the board revision, known once GPIO is set up
+            self.fetchPins();
         }
     }
 
@@ -0,0 +1,73 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+from .gpio_backend import monotonic
+
+
+class StatusPublisher(object):
+    # pushes the filament status to the browsers only when the filament state of a sensor changed and at most
+    # once per interval, updates arriving within the interval are coalesced into one push at its end.
+    # Every push carries a sequence number, together with the epoch (changes with every start of the plugin)
+    # it lets clients drop messages older than the snapshot they already have.
+
+    def __init__(self, collect, send, interval):
+        # collect() returns the current status: dict(noFilament=..., sensors=[Sensor.to_dict(), ...])
+        self._collect = collect
+        # send(payload) delivers a push to all clients
+        self._send = send
+        # shortest time between two pushes, in seconds
+        self.interval = interval
+        self.epoch = int(time.time() * 1000)
+        self.seq = 0
+        self._lock = threading.Lock()
+        self._last_key = None
+        self._last_sent = None
+        self._msg = None
+        self._timer = None
+
+    @staticmethod
+    def _key(status):
+        return tuple((sensor["index"], sensor["noFilament"]) for sensor in status["sensors"])
+
+    # the state changed, msg describes the change for the browser console
+    def update(self, msg=None):
+        with self._lock:
+            self._msg = msg
+            if self._timer is not None:
+                # the pending push picks the latest state up
+                return
+            delay = 0 if self._last_sent is None else self._last_sent + self.interval - monotonic()
+            if delay > 0:
+                self._timer = threading.Timer(delay, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self._flush()
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            status = self._collect()
+            key = self._key(status)
+            if key == self._last_key:
+                # changed back within the interval, or nothing changed at all
+                return
+            self._last_key = key
+            self._last_sent = monotonic()
+            self.seq += 1
+            payload = dict(status, seq=self.seq, epoch=self.epoch, msg=self._msg)
+        self._send(payload)
+
+    # current status for a client that just connected, no hardware is read
+    def snapshot(self):
+        with self._lock:
+            return dict(self._collect(), seq=self.seq, epoch=self.epoch)
+
+    def stop(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
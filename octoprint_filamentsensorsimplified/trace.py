@@ -0,0 +1,65 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import itertools
+from time import time
+
+from .gpio_backend import monotonic
+
+# event kinds
+EDGE = 1
+READ = 2
+STATE = 3
+RUNOUT = 4
+ONE_SHOT = 5
+HOOK = 6
+READ_ERROR = 7
+JAM = 8
+
+KIND_NAMES = {EDGE: "edge", READ: "read", STATE: "state", RUNOUT: "runout", ONE_SHOT: "one_shot", HOOK: "hook",
+              READ_ERROR: "read_error", JAM: "jam"}
+
+
+class TraceBuffer(object):
+    # fixed-size ring of sensor and hook events kept in preallocated parallel lists, recording an event
+    # allocates nothing but the values passed in and takes no lock. Slots are claimed from an
+    # itertools.count which is atomic under the GIL, an event being overwritten while dump() runs can show
+    # up half written.
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._times = [0.0] * size
+        self._kinds = [0] * size
+        self._sources = [None] * size
+        self._values = [None] * size
+        self._counter = itertools.count()
+        # sequence number of the latest recorded event
+        self._latest = -1
+
+    # source is usually the sensor name or the hook, value whatever describes the event
+    def record(self, kind, source=None, value=None):
+        sequence = next(self._counter)
+        i = sequence % self.size
+        self._times[i] = monotonic()
+        self._kinds[i] = kind
+        self._sources[i] = source
+        self._values[i] = value
+        if sequence > self._latest:
+            self._latest = sequence
+
+    def dump(self, limit=None):
+        # oldest first, times converted to the wall clock
+        end = self._latest + 1
+        start = max(0, end - self.size)
+        if limit is not None:
+            start = max(start, end - limit)
+        offset = time() - monotonic()
+        events = []
+        for sequence in range(start, end):
+            i = sequence % self.size
+            kind = self._kinds[i]
+            if not kind:
+                continue
+            events.append(dict(seq=sequence, time=self._times[i] + offset, kind=KIND_NAMES.get(kind, kind),
+                               source=self._sources[i], value=self._values[i]))
+        return events
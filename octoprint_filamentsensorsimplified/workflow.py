@@ -0,0 +1,69 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+
+# states of the filament change workflow
+IDLE = "idle"
+# runout action sent to OctoPrint, not seen going out to the printer yet
+RUNOUT_PENDING = "runout_pending"
+# filament change command sent to the printer
+COMMAND_SENT = "command_sent"
+# printer waits for the user to put in new filament
+PAUSED_FOR_USER = "paused_for_user"
+# user confirmed, printer finishes the change
+RESUMING = "resuming"
+
+# events
+RUNOUT = "runout"
+COMMAND = "command"
+PAUSED = "paused"
+PROCESSING = "processing"
+CHANGE_ENDED = "change_ended"
+RESET = "reset"
+
+# (state, event) -> new state, events not listed for a state are ignored, RESET always goes back to IDLE
+TRANSITIONS = {
+    (IDLE, RUNOUT): RUNOUT_PENDING,
+    (IDLE, COMMAND): COMMAND_SENT,
+    (RUNOUT_PENDING, COMMAND): COMMAND_SENT,
+    (COMMAND_SENT, COMMAND): COMMAND_SENT,
+    (COMMAND_SENT, PAUSED): PAUSED_FOR_USER,
+    (RESUMING, PAUSED): PAUSED_FOR_USER,
+    (PAUSED_FOR_USER, PROCESSING): RESUMING,
+    (PAUSED_FOR_USER, CHANGE_ENDED): IDLE,
+    (RESUMING, CHANGE_ENDED): IDLE
+}
+
+# states in which the printer runs the filament change and its responses matter
+PRINTER_CHANGING = frozenset((COMMAND_SENT, PAUSED_FOR_USER, RESUMING))
+
+# states in which the next line sent to the printer ends the filament change
+CHANGE_STARTED = frozenset((PAUSED_FOR_USER, RESUMING))
+
+
+class Workflow(object):
+    # filament change workflow shared by the GPIO, comm and event threads. Transitions are checked and applied
+    # under a lock so two threads can't both start a runout, state is replaced as a whole and can be read
+    # without locking.
+
+    def __init__(self):
+        self.state = IDLE
+        self._lock = threading.Lock()
+
+    # applies the event, returns the previous state or None if the event doesn't apply to the current state
+    def fire(self, event):
+        with self._lock:
+            previous = self.state
+            target = IDLE if event == RESET else TRANSITIONS.get((previous, event))
+            if target is None:
+                return None
+            self.state = target
+        return previous
+
+    @property
+    def idle(self):
+        return self.state is IDLE
+
+    def __repr__(self):
+        return "Workflow(state=%s)" % self.state
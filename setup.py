@@ -33,7 +33,8 @@ plugin_url = "https://github.com/luckyx182/Filament_sensor_simplified"
 plugin_license = "AGPLv3"
 
 # Any additional requirements besides OctoPrint should be listed here
-plugin_requires = ['RPi.GPIO']
+# RPi.GPIO only builds on the Pi, elsewhere the plugin loads and the simulated or daemon backend can be used
+plugin_requires = ['RPi.GPIO; sys_platform == "linux" and platform_machine in "armv6l armv7l aarch64"']
 
 ### --------------------------------------------------------------------------------------------------------------------
 ### More advanced options that you usually shouldn't have to touch follow after this point